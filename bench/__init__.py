@@ -0,0 +1,40 @@
+"""
+Offline benchmarks for rubus.
+
+Every benchmark runs against local stand-ins only, so no network access is required.
+"""
+import argparse
+import http.server
+import json
+import threading
+
+
+def main(run, description):
+    """Command line entry point of a benchmark reporting the results of run() as JSON"""
+    parser = argparse.ArgumentParser(description=description.split('\n\n')[0])
+    parser.add_argument('--output', help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    text = json.dumps(run(), indent=4)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text)
+    else:
+        print(text)
+
+
+class LocalServer(http.server.ThreadingHTTPServer):
+    """HTTP server at 127.0.0.1 serving in a background thread while used as a context manager"""
+    daemon_threads = True
+
+    def __init__(self, handler, port=0):
+        super().__init__(('127.0.0.1', port), handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
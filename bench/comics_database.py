@@ -0,0 +1,24 @@
+"""
+Set up rubus.comics against a fresh database and image storage for a benchmark.
+"""
+import os
+import threading
+
+from rubus import comics
+from rubus import helper
+
+
+def connect(directory):
+    """Point rubus.comics at the directory and start its database worker like comics.init would
+
+    As the database queues of rubus.comics are module level, this can be done once per process.
+    """
+    comics.DATABASE_FILEPATH = os.path.join(directory, "comics.db")
+    comics.IMAGES_DIRECTORY = os.path.join(directory, "comics")
+    worker = threading.Thread(
+        target=helper.database_worker,
+        args=(comics.DATABASE_FILEPATH, comics.queries),
+        daemon=True)
+    worker.start()
+    helper.database_migrate(comics.queries, comics.MIGRATIONS)
+    helper.database_readers_connect(comics.DATABASE_FILEPATH, comics.readers, comics.DATABASE_READERS)
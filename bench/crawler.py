@@ -0,0 +1,74 @@
+"""
+Measure the throughput of indexing comics with comics._update_index and the backfill.
+
+The comics are served by a local stand-in for hs.fi with a small delay per response
+in place of the network. First the latest strips are indexed from scratch, then the
+archives are backfilled without the polite interval in between the pages, and finally
+the index is refreshed when there is nothing new, which is what the daily update mostly does.
+Run from the repository root:
+
+    python -m bench.crawler [--output results.json]
+"""
+import tempfile
+import time
+
+import bench
+from bench import comics_database
+from bench.hs_fi import HsFi, LocalAdapter
+from rubus import comics
+
+
+COMICS = ("Fok_It", "Fingerpori", "Viivi ja Wagner", "Anonyymit eläimet", "B. Virtanen", "Kamala luonto")
+STRIPS = 30
+DELAY_SECONDS = 0.01
+
+
+def _update_index(site):
+    requests_start = site.requests
+    time_start = time.perf_counter()
+    comics._update_index()  # pylint: disable=protected-access
+    seconds = time.perf_counter() - time_start
+    return seconds, site.requests - requests_start
+
+
+def _backfill(site):
+    requests_start = site.requests
+    time_start = time.perf_counter()
+    for name in COMICS:
+        comics._backfill_comic(name)  # pylint: disable=protected-access
+    seconds = time.perf_counter() - time_start
+    return seconds, site.requests - requests_start
+
+
+def run():
+    """Index the latest comics from scratch, backfill the archives and then refresh without any new strips"""
+    with tempfile.TemporaryDirectory() as directory, HsFi(COMICS, STRIPS, DELAY_SECONDS) as site:
+        comics_database.connect(directory)
+        comics.session.mount("https://", LocalAdapter(
+            site.netloc, pool_maxsize=comics.CRAWLER['connections_per_host']))
+        comics.BACKFILL = {'enabled': True, 'interval_seconds': 0}
+
+        seconds_initial, requests_initial = _update_index(site)
+        seconds_backfill, requests_backfill = _backfill(site)
+        strips = comics.database_read_single("SELECT COUNT(*) FROM images")
+        seconds_refresh, requests_refresh = _update_index(site)
+
+    return {
+        'benchmark': 'crawler',
+        'comics': len(COMICS),
+        'strips_indexed': strips,
+        'strips_expected': len(COMICS) * STRIPS,
+        'delay_seconds': DELAY_SECONDS,
+        'workers': comics.CRAWLER['workers'],
+        'initial_seconds': seconds_initial,
+        'initial_requests': requests_initial,
+        'backfill_seconds': seconds_backfill,
+        'backfill_requests': requests_backfill,
+        'backfill_strips_per_second': (strips - len(COMICS)) / seconds_backfill,
+        'refresh_seconds': seconds_refresh,
+        'refresh_requests': requests_refresh,
+    }
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
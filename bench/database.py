@@ -0,0 +1,65 @@
+"""
+Measure the queries per second of helper.database_worker with concurrent callers.
+
+Each caller alternates between writing a row and reading one back through the worker,
+as the handlers do, so the single writer thread is the shared bottleneck.
+Run from the repository root:
+
+    python -m bench.database [--output results.json]
+"""
+import concurrent.futures
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import bench
+from rubus import helper
+
+
+CALLERS = (1, 4, 16)
+QUERIES_PER_CALLER = 2000
+
+
+def _caller(queries, caller):
+    for index in range(QUERIES_PER_CALLER // 2):
+        key = caller * QUERIES_PER_CALLER + index
+        helper.database_query(queries, "INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", key, str(key))
+        helper.database_query_single(queries, "SELECT value FROM entries WHERE key = ?", key)
+
+
+def _run_callers(callers):
+    with tempfile.TemporaryDirectory() as directory:
+        queries = queue.Queue()
+        worker = threading.Thread(
+            target=helper.database_worker,
+            args=(os.path.join(directory, "bench.db"), queries),
+            daemon=True)
+        worker.start()
+        helper.database_query(queries, "CREATE TABLE entries (key INTEGER PRIMARY KEY, value TEXT)")
+
+        time_start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(callers) as executor:
+            for future in [executor.submit(_caller, queries, caller) for caller in range(callers)]:
+                future.result()
+        seconds = time.perf_counter() - time_start
+
+    return {
+        'callers': callers,
+        'queries': callers * QUERIES_PER_CALLER,
+        'seconds': seconds,
+        'queries_per_second': callers * QUERIES_PER_CALLER / seconds,
+    }
+
+
+def run():
+    """Run the queries with each amount of concurrent callers"""
+    return {
+        'benchmark': 'database',
+        'runs': [_run_callers(callers) for callers in CALLERS],
+    }
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
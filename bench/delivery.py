@@ -0,0 +1,110 @@
+"""
+Measure the fan-out time of posting the daily comics with comics._post_comic_of_the_day.
+
+A fake Bot answers each request after a fixed latency in place of Telegram,
+so the result shows how the delivery copes with the rate limits and the round trips.
+Run from the repository root:
+
+    python -m bench.delivery [--output results.json]
+"""
+import datetime
+import itertools
+import os
+import tempfile
+import threading
+import time
+import types
+
+import bench
+from bench import comics_database
+from bench.hs_fi import jpeg
+from rubus import comics
+from rubus import delivery
+
+
+COMICS = ("Fok_It", "Fingerpori", "Viivi ja Wagner", "Kamala luonto")
+CHATS = 50
+COMICS_PER_CHAT = 2
+LATENCY_SECONDS = 0.05
+
+
+class FakeBot:
+    """Bot answering send_photo and send_media_group like Telegram after LATENCY_SECONDS"""
+    def __init__(self):
+        self.requests = 0
+        self.photos = 0
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.lock = threading.Lock()
+        self.file_ids = itertools.count()
+
+    def _request(self, photos):
+        """Count the photos, each of which is either a file_id or the content to upload"""
+        time.sleep(LATENCY_SECONDS)
+        with self.lock:
+            self.requests += 1
+            for photo in photos:
+                self.photos += 1
+                if not isinstance(photo, str):
+                    self.uploads += 1
+                    self.upload_bytes += len(photo)
+        return [
+            types.SimpleNamespace(photo=[types.SimpleNamespace(file_id=f"file-{next(self.file_ids)}")])
+            for _ in photos
+        ]
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):  # pylint: disable=unused-argument
+        """Pretend to send the photo"""
+        return self._request([photo if isinstance(photo, str) else photo.read()])[0]
+
+    def send_media_group(self, chat_id, media, **kwargs):  # pylint: disable=unused-argument
+        """Pretend to send the album"""
+        return self._request([
+            item.media if isinstance(item.media, str) else item.media.input_file_content for item in media])
+
+
+def _plan(directory):
+    filepath = os.path.join(directory, "strip.jpg")
+    with open(filepath, 'wb') as outfile:
+        outfile.write(jpeg((1920, 600)))
+
+    today_str = datetime.date.today().strftime(r"%Y-%m-%d")
+    rendition = comics._rendition(filepath)  # pylint: disable=protected-access
+    comics.database_query_many(
+        "INSERT INTO images (name, date, filepath, rendition) VALUES (?, ?, ?, ?)",
+        [(name, today_str, filepath, rendition) for name in COMICS])
+    comics.database_query_many(
+        "INSERT INTO daily_posts (chat_id, name) VALUES (?, ?)",
+        [(chat_id, COMICS[(chat_id + offset) % len(COMICS)])
+         for chat_id in range(CHATS) for offset in range(COMICS_PER_CHAT)])
+
+
+def run():
+    """Post the comics of the day to all the chats"""
+    with tempfile.TemporaryDirectory() as directory:
+        comics_database.connect(directory)
+        _plan(directory)
+
+        bot = FakeBot()
+        time_start = time.perf_counter()
+        comics._post_comic_of_the_day(types.SimpleNamespace(bot=bot))  # pylint: disable=protected-access
+        seconds = time.perf_counter() - time_start
+
+    return {
+        'benchmark': 'delivery',
+        'chats': CHATS,
+        'photos_expected': CHATS * COMICS_PER_CHAT,
+        'latency_seconds': LATENCY_SECONDS,
+        'workers': delivery.CONFIG['workers'],
+        'messages_per_second_limit': delivery.CONFIG['messages_per_second'],
+        'requests': bot.requests,
+        'photos': bot.photos,
+        'uploads': bot.uploads,
+        'upload_bytes': bot.upload_bytes,
+        'seconds': seconds,
+        'photos_per_second': bot.photos / seconds,
+    }
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
@@ -0,0 +1,143 @@
+"""
+Local stand-in for the comic pages at hs.fi and the images at hs.mediadelivery.fi.
+
+The pages are rendered from the fixtures in fixtures/hs_fi, which keep the structure
+of the real pages used by rubus.parsing. Every comic has a chain of daily strips
+linked backwards with the "Previous" button just like the real site.
+"""
+import datetime
+import http.server
+import io
+import os
+import string
+import threading
+import time
+import urllib.parse
+
+import requests.adapters
+from PIL import Image
+
+import bench
+
+
+DIRECTORY_FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "hs_fi")
+DATE_FIRST = datetime.date(2019, 1, 1)
+DAYS_OF_WEEK = ("ma", "ti", "ke", "to", "pe", "la", "su")
+IMAGE_SIZE_PIXELS = (1920, 600)
+
+
+def _template(filename):
+    with open(os.path.join(DIRECTORY_FIXTURES, filename)) as infile:
+        return string.Template(infile.read())
+
+
+def jpeg(size):
+    """A JPEG image of the size with some detail to compress, alike to a photo or a comic strip"""
+    image = Image.merge('RGB', [
+        Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 64),
+        Image.linear_gradient('L').resize(size),
+        Image.effect_noise(size, 32),
+    ])
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class HsFi(bench.LocalServer):
+    """Serve the comics with the given amount of strips each at http://127.0.0.1:<port>/
+
+    Each response is delayed by delay_seconds to account for the network round trip.
+    """
+    def __init__(self, comics, strips, delay_seconds=0, port=0):
+        super().__init__(_Handler, port)
+        self.comics = {name.lower().replace(' ', '-'): name for name in comics}
+        self.strips = strips
+        self.delay_seconds = delay_seconds
+        self.image = jpeg(IMAGE_SIZE_PIXELS)
+        self.templates = {
+            name: _template(f"{name}.html")
+            for name in ('frontpage', 'frontpage_cartoon', 'homepage', 'comic', 'comic_previous')
+        }
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+
+    @property
+    def netloc(self):
+        """Host and port of the server"""
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def page(self, path):
+        """Content of the page at the path or None if there is no such page"""
+        parts = path.strip('/').split('/')
+        if parts == ['sarjakuvat']:
+            return self._frontpage()
+        if len(parts) == 2 and parts[0] == 'sarjakuvat' and parts[1] in self.comics:
+            return self._homepage(parts[1])
+        if len(parts) == 3 and parts[0] == 'sarjakuvat' and parts[1] in self.comics:
+            return self._comic(parts[1], int(parts[2].split('-')[-1].split('.')[0]))
+        if len(parts) == 3 and parts[0] == 'img':
+            # Every strip must have distinct content or the storage would deduplicate them
+            return self.image + parts[2].encode('utf-8')
+        return None
+
+    def _frontpage(self):
+        cartoons = "\n".join(
+            self.templates['frontpage_cartoon'].substitute(name=name, slug=slug, uri=f"/sarjakuvat/{slug}/")
+            for slug, name in self.comics.items())
+        return self.templates['frontpage'].substitute(cartoons=cartoons)
+
+    def _homepage(self, slug):
+        return self.templates['homepage'].substitute(
+            name=self.comics[slug], slug=slug, uri_latest=f"/sarjakuvat/{slug}/car-{self.strips}.html")
+
+    def _comic(self, slug, number):
+        date = DATE_FIRST + datetime.timedelta(days=number)
+        navigation = "" if number <= 1 else self.templates['comic_previous'].substitute(
+            uri_previous=f"/sarjakuvat/{slug}/car-{number - 1}.html")
+        return self.templates['comic'].substitute(
+            name=self.comics[slug],
+            slug=slug,
+            date=f"{DAYS_OF_WEEK[date.weekday()]} {date.strftime(r'%d.%m.%Y')}",
+            image_uri=f"//hs.mediadelivery.fi/img/{slug}/{number}.jpg",
+            navigation=navigation)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive like the real servers
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Respond with the page or 404"""
+        with self.server.requests_lock:
+            self.server.requests += 1
+        time.sleep(self.server.delay_seconds)
+        content = self.server.page(urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        if content is None:
+            self.send_error(404)
+            return
+
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the benchmark output clean"""
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter sending every request to the local server at netloc instead
+
+    Mounted on a session, the requests keep their original URLs everywhere else,
+    so the code under benchmark can't tell the difference.
+    """
+    def __init__(self, netloc, **kwargs):
+        super().__init__(**kwargs)
+        self.netloc = netloc
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """Send the request to the local server"""
+        parts = urllib.parse.urlsplit(request.url)
+        request.url = urllib.parse.urlunsplit(('http', self.netloc, parts.path, parts.query, ''))
+        return super().send(request, **kwargs)
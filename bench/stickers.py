@@ -0,0 +1,62 @@
+"""
+Measure converting photos of various sizes to stickers with stickers._resize_and_convert_to_png.
+
+The photo is handed over by a fake Bot in place of downloading it from Telegram,
+so only the conversion itself is measured.
+Run from the repository root:
+
+    python -m bench.stickers [--output results.json]
+"""
+import time
+import types
+
+import bench
+from bench.hs_fi import jpeg
+from rubus import stickers
+
+
+SIZES_PIXELS = ((640, 480), (1280, 960), (1920, 1080), (2560, 1920), (4032, 3024))
+REPEATS = 5
+
+
+def _update_and_context(image_data):
+    photo = types.SimpleNamespace(file_id="photo", file_size=len(image_data))
+    file = types.SimpleNamespace(download_as_bytearray=lambda: bytearray(image_data))
+    update = types.SimpleNamespace(message=types.SimpleNamespace(photo=[photo]))
+    context = types.SimpleNamespace(bot=types.SimpleNamespace(get_file=lambda file_id: file))
+    return update, context
+
+
+def _convert(size):
+    image_data = jpeg(size)
+    update, context = _update_and_context(image_data)
+
+    seconds = []
+    for _ in range(REPEATS):
+        time_start = time.perf_counter()
+        png = stickers._resize_and_convert_to_png(update, context)  # pylint: disable=protected-access
+        seconds.append(time.perf_counter() - time_start)
+
+    return {
+        'width': size[0],
+        'height': size[1],
+        'jpeg_bytes': len(image_data),
+        'png_bytes': len(png.getvalue()),
+        'seconds_min': min(seconds),
+        'seconds_mean': sum(seconds) / len(seconds),
+    }
+
+
+def run():
+    """Convert a photo of each size"""
+    # Start up the conversion pool so its startup isn't counted for the first size
+    _convert(SIZES_PIXELS[0])
+    return {
+        'benchmark': 'stickers',
+        'repeats': REPEATS,
+        'conversions': [_convert(size) for size in SIZES_PIXELS],
+    }
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
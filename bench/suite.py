@@ -0,0 +1,60 @@
+"""
+Run all the benchmarks and collect their results into a single JSON document.
+
+Each benchmark is run in its own process, so no state such as the database workers
+or the process pools is shared between them. The results include the version and
+the commit, so runs of different versions can be compared with each other.
+Run from the repository root:
+
+    python -m bench.suite [--output results.json]
+"""
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+import bench
+
+
+BENCHMARKS = ("crawler", "database", "stickers", "delivery", "webhook")
+
+
+def _version():
+    with open("pyproject.toml") as infile:
+        for line in infile:
+            if line.startswith("version"):
+                return line.split('=')[1].strip().strip('"')
+    return None
+
+
+def _commit():
+    result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=False)
+    return result.stdout.strip() or None
+
+
+def _run_benchmark(name):
+    result = subprocess.run([sys.executable, "-m", f"bench.{name}"], capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        return {'benchmark': name, 'error': result.stderr.strip().split('\n')[-1]}
+    return json.loads(result.stdout)
+
+
+def run():
+    """Run all the benchmarks one after another"""
+    results = {
+        'version': _version(),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'started': datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+        'benchmarks': {},
+    }
+    for name in BENCHMARKS:
+        print(f"Running {name}...", file=sys.stderr)
+        results['benchmarks'][name] = _run_benchmark(name)
+    return results
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
@@ -0,0 +1,71 @@
+"""
+Local stand-in for the Telegram Bot API.
+
+Answers every method with a successful response, which is enough for the Updater
+to run against it. Updates pushed to it are served through getUpdates.
+"""
+import http.server
+import json
+import threading
+
+import bench
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "Rubus", 'username': "rubus_bench_bot"}
+
+
+class TelegramApi(bench.LocalServer):
+    """Serve the Bot API at http://127.0.0.1:<port>/bot<token>/<method>"""
+    def __init__(self, port=0):
+        super().__init__(_Handler, port)
+        self.updates = []
+        self.updates_available = threading.Condition()
+        self.calls = []
+
+    @property
+    def base_url(self):
+        """Value for the base_url of the Bot"""
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def push(self, update):
+        """Make an update available for getUpdates"""
+        with self.updates_available:
+            self.updates.append(update)
+            self.updates_available.notify_all()
+
+    def get_updates(self, offset, timeout):
+        """Long poll for the updates with update_id of at least offset"""
+        with self.updates_available:
+            self.updates_available.wait_for(
+                lambda: any(update['update_id'] >= offset for update in self.updates), timeout)
+            return [update for update in self.updates if update['update_id'] >= offset]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Respond to any Bot API method"""
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.calls.append(method)
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            params = json.loads(body or b"{}")
+            offset, timeout = int(params.get('offset') or 0), float(params.get('timeout') or 0)
+            result = self.server.get_updates(offset, timeout)
+        else:
+            result = True
+
+        response = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the benchmark output clean"""
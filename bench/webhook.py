@@ -0,0 +1,101 @@
+"""
+Compare the update-to-handler latency and the idle CPU usage of polling and webhook modes.
+
+Recorded updates are replayed either through a local stand-in for Telegram serving
+getUpdates or by POSTing them straight to the webhook listener of the Updater.
+Run from the repository root:
+
+    python -m bench.webhook [--output results.json]
+"""
+import json
+import os
+import statistics
+import threading
+import time
+
+import requests
+from telegram.ext import Filters, MessageHandler, Updater
+
+import bench
+from bench.telegram_api import TelegramApi
+
+
+FILEPATH_UPDATES = os.path.join(os.path.dirname(__file__), "fixtures", "updates.json")
+TOKEN = "123456:BENCH"
+PORT_WEBHOOK = 18443
+IDLE_SECONDS = 5
+REPLAYS = 20
+REPLAY_INTERVAL_SECONDS = 0.05
+
+
+def _replayed_updates():
+    with open(FILEPATH_UPDATES) as infile:
+        recorded = json.load(infile)
+
+    updates = []
+    for index in range(REPLAYS * len(recorded)):
+        update = json.loads(json.dumps(recorded[index % len(recorded)]))
+        update['update_id'] = index + 1
+        updates.append(update)
+    return updates
+
+
+def run_mode(mode):
+    """Replay the updates in the given mode, 'polling' or 'webhook'"""
+    updates = _replayed_updates()
+    time_received = {}
+    all_received = threading.Event()
+
+    def receive(update, context):  # pylint: disable=unused-argument
+        time_received[update.update_id] = time.perf_counter()
+        if len(time_received) == len(updates):
+            all_received.set()
+
+    with TelegramApi() as api:
+        updater = Updater(TOKEN, base_url=api.base_url, use_context=True)
+        updater.dispatcher.add_handler(MessageHandler(Filters.all, receive))
+        if mode == 'webhook':
+            updater.start_webhook(listen='127.0.0.1', port=PORT_WEBHOOK, url_path=TOKEN)
+        else:
+            updater.start_polling(poll_interval=0.1)
+
+        time_cpu_start = time.process_time()
+        time.sleep(IDLE_SECONDS)
+        idle_cpu_seconds = time.process_time() - time_cpu_start
+
+        time_sent = {}
+        with requests.Session() as session:
+            for update in updates:
+                time_sent[update['update_id']] = time.perf_counter()
+                if mode == 'webhook':
+                    session.post(f"http://127.0.0.1:{PORT_WEBHOOK}/{TOKEN}", json=update)
+                else:
+                    api.push(update)
+                time.sleep(REPLAY_INTERVAL_SECONDS)
+
+        all_received.wait(timeout=30)
+        updater.stop()
+
+    latencies_ms = sorted(
+        (time_received[update_id] - time_sent[update_id]) * 1000 for update_id in time_received)
+    return {
+        'mode': mode,
+        'updates_sent': len(updates),
+        'updates_received': len(latencies_ms),
+        'idle_cpu_seconds_per_second': idle_cpu_seconds / IDLE_SECONDS,
+        'latency_ms_median': statistics.median(latencies_ms),
+        'latency_ms_p99': latencies_ms[int(len(latencies_ms) * 0.99) - 1],
+        'latency_ms_max': latencies_ms[-1],
+    }
+
+
+def run():
+    """Replay the updates in both modes"""
+    return {
+        'benchmark': 'webhook',
+        'modes': [run_mode('polling'), run_mode('webhook')],
+    }
+
+
+if __name__ == '__main__':
+    bench.main(run, __doc__)
@@ -4,26 +4,37 @@ Handle posting of hs.fi comics when requested.
 The bot can automatically download local copies of the comics available at hs.fi,
 then post then either on request or as daily scheduled posts.
 """
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import enum
 import functools
-import itertools
+import io
 import logging
 import os
 import queue
+import random
 import threading
+import time
 import urllib.parse
 
 import requests
-from bs4 import BeautifulSoup
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import requests.adapters
+from PIL import Image
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler
 from telegram.ext import Filters
 
+from rubus import delivery
 from rubus import helper
+from rubus import metrics
+from rubus import parsing
+from rubus import storage
 
 
-logger = logging.getLogger('rubus')
+logger = logging.getLogger(__name__)
 
 CONFIG = helper.config_load()
 URL_SCHEME = "https"
@@ -31,12 +42,106 @@ URL_HOST = "hs.fi"
 URL_BASE = f"{URL_SCHEME}://{URL_HOST}"
 URL_COMICS = f"{URL_BASE}/sarjakuvat/"
 
-# Multi-threading SQL queries shall be synchronized over these Queue objects
+# All crawling is done over a shared keep-alive session by a bounded pool of workers.
+# The amount of simultaneous requests to a single host is limited separately
+# as most of the requests go to the same few hosts anyway.
+CRAWLER = CONFIG['comics']['crawler']
+# The archives are crawled separately from the daily update, one page per interval_seconds
+BACKFILL = CONFIG['comics']['backfill']
+BACKFILL_RETRY_SECONDS = 60 * 60
+# A comic stuck on a broken page is left alone after this many failures in a row
+BACKFILL_FAILURES_MAX = 10
+BACKFILL_LOG_INTERVAL_PAGES = 100
+
+# The images are uploaded to Telegram as renditions re-encoded at index time, keeping the originals.
+# Telegram scales photos down to RENDITION_DIMENSION_MAX_PIXELS anyway, so there is nothing to lose.
+RENDITION_DIMENSION_MAX_PIXELS = 1280
+RENDITION_JPEG_QUALITY = 85
+RENDITION_WORKERS = 2
+RENDITION_BATCH_SIZE = 100
+MEDIA_GROUP_SIZE_MAX = 10  # Per Telegram album limits
+
+# The archive is browsed with keyset pagination over the images_name_date index, so each step
+# costs the same regardless of how deep into the archive it is. The buttons refer to the current
+# strip by its rowid, which keeps the callback data well within the 64 bytes Telegram allows.
+# As the buttons carry all the state, they work for anyone in the chat and across restarts.
+CALLBACK_PREFIX_BROWSE = "browse:"
+CALLBACK_BROWSE_CLOSE = f"{CALLBACK_PREFIX_BROWSE}close"
+STATEMENT_BROWSE = (
+    "SELECT images.rowid, images.name, images.date, COALESCE(images.rendition, images.filepath), images.file_id "
+    "FROM images JOIN images AS current ON current.rowid = ? AND images.name = current.name ")
+STATEMENTS_BROWSE = {
+    'older': STATEMENT_BROWSE + "WHERE images.date < current.date ORDER BY images.date DESC LIMIT 1",
+    'newer': STATEMENT_BROWSE + "WHERE images.date > current.date ORDER BY images.date ASC LIMIT 1",
+}
+rendition_pool = helper.ProcessPool(RENDITION_WORKERS)
+session = requests.Session()
+session.mount(f"{URL_SCHEME}://", requests.adapters.HTTPAdapter(pool_maxsize=CRAWLER['connections_per_host']))
+host_limits = {}
+host_limits_lock = threading.Lock()
+
+# Ids of the images per comic for picking random ones without scanning the images table
+image_ids = {}
+image_ids_lock = threading.Lock()
+
+# The menus are rendered from cached sources and daily_posts of each chat.
+# _update_index refreshes the sources and _schedule_post keeps the subscriptions up to date.
+cache = {'sources': None, 'subscriptions': {}}
+cache_lock = threading.Lock()
+
+# Set once the index has been refreshed in the background after startup
+ready = threading.Event()
+# Set by every refresh of the index, which may have found new comics for the backfill
+backfill_wakeup = threading.Event()
+
+# Multi-threading SQL writes shall be synchronized over the queries Queue
+# while the lookups done by the handlers may use any connection from the readers pool
 DATABASE_FILEPATH = os.path.join(CONFIG['filepaths']['storage'], "comics.db")
+IMAGES_DIRECTORY = os.path.join(CONFIG['filepaths']['storage'], "comics")
+DATABASE_READERS = 4
 queries = queue.Queue()
-results = queue.Queue()
-database_query = functools.partial(helper.database_query, queries, results)
-database_query_single = functools.partial(helper.database_query_single, queries, results)
+readers = queue.Queue()
+database_query = functools.partial(helper.database_query, queries)
+database_query_single = functools.partial(helper.database_query_single, queries)
+database_query_many = functools.partial(helper.database_query_many, queries)
+database_transaction = functools.partial(helper.database_transaction, queries)
+database_read = functools.partial(helper.database_read, readers)
+database_read_single = functools.partial(helper.database_read_single, readers)
+database_observe = functools.partial(metrics.observe, "rubus_database_query_duration_seconds", database="comics")
+
+# Append only, see helper.database_migrate
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS sources (name TEXT UNIQUE, url TEXT)",
+        "CREATE TABLE IF NOT EXISTS images (name TEXT, date DATE, filepath TEXT NOT NULL, file_id TEXT)",
+        "CREATE TABLE IF NOT EXISTS daily_posts (chat_id INTEGER, name TEXT, UNIQUE(chat_id, name))",
+    ],
+    [
+        # Crawls interrupted before the unique index existed may have stored the same strip twice.
+        # Keep the latest copy as the older ones may point to an already overwritten file.
+        "DELETE FROM images WHERE rowid NOT IN (SELECT MAX(rowid) FROM images GROUP BY name, date)",
+        "CREATE UNIQUE INDEX images_name_date ON images (name, date)",
+        # Lookups of daily_posts by chat_id are already served by the UNIQUE(chat_id, name) index
+    ],
+    [
+        # Page URL of each strip, which allows the crawl to stop before fetching known pages
+        "ALTER TABLE images ADD COLUMN url TEXT",
+        "CREATE INDEX images_url ON images (url)",
+    ],
+    [
+        # Frontier of the backfill of each comic, url_next is the next older page to visit
+        "CREATE TABLE backfill (name TEXT PRIMARY KEY, url_next TEXT, date_oldest DATE, "
+        "pages INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0)",
+    ],
+    [
+        # Filepath of the image to upload to Telegram, NULL until the rendition has been created
+        "ALTER TABLE images ADD COLUMN rendition TEXT",
+    ],
+    [
+        # Consecutive failures to backfill the comic, reset whenever a page has been backfilled
+        "ALTER TABLE backfill ADD COLUMN failures INTEGER NOT NULL DEFAULT 0",
+    ],
+]
 
 
 class State(enum.IntEnum):
@@ -48,6 +153,7 @@ class State(enum.IntEnum):
     MENU = enum.auto()
     SCHEDULE = enum.auto()
     RANDOM = enum.auto()
+    BROWSE_SELECT = enum.auto()
 
 
 class Command(enum.IntEnum):
@@ -58,6 +164,7 @@ class Command(enum.IntEnum):
     SCHEDULE_MENU = enum.auto()
     RANDOM_MENU = enum.auto()
     CANCEL = enum.auto()
+    BROWSE_MENU = enum.auto()
 
 
 def init(dispatcher):
@@ -65,13 +172,22 @@ def init(dispatcher):
     logger.info("Setting up database worker")
     worker = threading.Thread(
         target=helper.database_worker,
-        args=(DATABASE_FILEPATH, queries, results),
+        args=(DATABASE_FILEPATH, queries, database_observe),
         daemon=True)
     worker.start()
+    metrics.gauge("rubus_database_queue_depth", queries.qsize, database="comics")
 
     logger.info("Updating database for comics")
-    _create_database_tables()
-    _update_index()
+    storage.cleanup(IMAGES_DIRECTORY)
+    helper.database_migrate(queries, MIGRATIONS)
+    helper.database_readers_connect(DATABASE_FILEPATH, readers, DATABASE_READERS)
+
+    # Everything indexed earlier can be served right away, so the bot doesn't wait for the crawl
+    logger.info("Refreshing the index of comics in the background")
+    metrics.gauge("rubus_ready", lambda: int(ready.is_set()), component="comics")
+    threading.Thread(target=_update_index_initial, name="comics-index", daemon=True).start()
+    if BACKFILL['enabled']:
+        threading.Thread(target=_backfill, name="comics-backfill", daemon=True).start()
 
     logger.info("Scheduling job to post comics daily")
     job_queue = dispatcher.job_queue
@@ -84,51 +200,177 @@ def init(dispatcher):
     job_queue.run_daily(_post_comic_of_the_day, time_post)
 
 
-def _create_database_tables():
-    database_query("CREATE TABLE IF NOT EXISTS sources (name TEXT UNIQUE, url TEXT)")
-    database_query(
-        "CREATE TABLE IF NOT EXISTS images "
-        "(name TEXT, date DATE, filepath TEXT NOT NULL, file_id TEXT)")
-    database_query(
-        "CREATE TABLE IF NOT EXISTS daily_posts "
-        "(chat_id INTEGER, name TEXT, UNIQUE(chat_id, name))")
-
-
+@metrics.timed('job')
 def _update_index(*args):  # pylint: disable=unused-argument
     """Download all comics we haven't yet stored"""
     comics_available = _fetch_comics_available()
-    for comic in comics_available:
-        database_query(
-            "INSERT OR REPLACE INTO sources (name, url) values (?, ?)", comic['name'], comic['url'])
-        _update_index_of_comic(comic)
-    logger.info("Database updated")
+    database_query_many(
+        "INSERT OR REPLACE INTO sources (name, url) values (?, ?)",
+        [(comic['name'], comic['url']) for comic in comics_available])
+    _sources_refresh()
+
+    time_start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(CRAWLER['workers'], thread_name_prefix="crawler") as executor:
+        futures = {executor.submit(_update_index_of_comic, comic): comic for comic in comics_available}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:  # pylint: disable=broad-except
+                # A single broken comic page must not prevent updating the rest
+                logger.exception(f"Failed to update index of {futures[future]['name']}")
+    logger.info(f"Database updated in {time.monotonic() - time_start:.1f} s")
+    backfill_wakeup.set()
+
+
+def _update_index_initial():
+    """Refresh the index after startup and report being ready once done, even if it failed"""
+    time_start = time.monotonic()
+    try:
+        _update_index()
+    except Exception:  # pylint: disable=broad-except
+        # The comics indexed earlier are still available and the daily update will try again
+        logger.exception("Failed to refresh the index of comics")
+    ready.set()
+    logger.info(f"Comics ready in {time.monotonic() - time_start:.1f} s")
+    _renditions_create_missing()
 
 
 def _update_index_of_comic(comic):
     comic_latest_stored_date_str = database_query_single(
-        "SELECT date FROM images WHERE name = ? ORDER BY date DESC", comic['name'])
+        "SELECT date FROM images WHERE name = ? ORDER BY date DESC LIMIT 1", comic['name'])
     comic_homepage_url = database_query_single(
         "SELECT url FROM sources WHERE name = ?", comic['name'])
 
-    url_start_from = _fetch_comic_url_latest(comic_homepage_url)
-    for url in _fetch_comic_url_all(url_start_from):
-        data = _download_comic(url)
-
-        date_str = data['date'].strftime(r"%Y-%m-%d")
-        if date_str == comic_latest_stored_date_str:
-            logger.debug(f"{comic['name']} for date {date_str} already indexed")
-            break
+    # All new images of the comic are committed at once so an interrupted crawl
+    # can't leave a comic partially indexed, which would stop the next crawl too early
+    with database_transaction() as transaction:
+        url_start_from = _fetch_comic_url_latest(comic_homepage_url)
+        for page in _fetch_comic_pages(url_start_from, _is_page_indexed):
+            date_str = page['date'].strftime(r"%Y-%m-%d")
+            # Images indexed before the page URLs were stored can only be recognized by their date
+            if comic_latest_stored_date_str is not None and date_str <= comic_latest_stored_date_str:
+                logger.debug(f"{comic['name']} for date {date_str} already indexed")
+                break
+
+            # Only now that we know the strip is new it is worth downloading the image
+            filepath = __download_comic_image(page['image_url'])
+            logger.debug(f"Fetched information for {comic['name']} of {date_str}")
+            transaction.execute(
+                "INSERT OR IGNORE INTO images (name, date, filepath, url, rendition) values (?, ?, ?, ?, ?)",
+                comic['name'], date_str, filepath, page['url'], _rendition(filepath))
+            if comic_latest_stored_date_str is None and BACKFILL['enabled']:
+                # The rest of the archive of a new comic is left for the backfill
+                break
+
+    with image_ids_lock:
+        image_ids.pop(comic['name'], None)
+
+
+def _backfill():
+    """Crawl the archives of the comics backwards from the oldest indexed strips
+
+    Once the beginning of every archive has been reached, waits for the index to be refreshed,
+    which may have added new comics. Failed ones are retried once in a while, up to
+    BACKFILL_FAILURES_MAX times in a row. The frontier of each comic is stored along with
+    the indexed strips, so after a restart the backfill continues from where it was left.
+    """
+    # The sources and the latest strips must be indexed first
+    ready.wait()
+    while True:
+        # Cleared before looking, so a refresh finishing meanwhile isn't missed
+        backfill_wakeup.clear()
+        names = [name for (name,) in database_read(
+            "SELECT sources.name FROM sources LEFT JOIN backfill ON backfill.name = sources.name "
+            "WHERE backfill.done IS NOT 1 AND COALESCE(backfill.failures, 0) < ?", BACKFILL_FAILURES_MAX)]
+        if not names:
+            logger.info("Backfill of all comics complete")
+            backfill_wakeup.wait()
+            continue
 
-        logger.debug(f"Fetched information for {comic['name']} of {date_str}")
-        database_query(
-            "INSERT INTO images (name, date, filepath) values (?, ?, ?)",
-            comic['name'], date_str, data['filepath'])
+        failed = False
+        for name in names:
+            try:
+                _backfill_comic(name)
+            except Exception:  # pylint: disable=broad-except
+                # A single broken page must not prevent backfilling the rest
+                logger.exception(f"Failed to backfill {name}")
+                _backfill_failed(name)
+                failed = True
+        if failed:
+            backfill_wakeup.wait(BACKFILL_RETRY_SECONDS)
+
+
+def _backfill_failed(name):
+    with database_transaction() as transaction:
+        # The comic may have failed before its frontier was even found
+        transaction.execute("INSERT OR IGNORE INTO backfill (name) VALUES (?)", name)
+        transaction.execute("UPDATE backfill SET failures = failures + 1 WHERE name = ?", name)
+
+    url_next, failures = database_read_single("SELECT url_next, failures FROM backfill WHERE name = ?", name)
+    if failures >= BACKFILL_FAILURES_MAX:
+        logger.warning(f"Giving up backfilling {name} at {url_next} after {failures} failures in a row")
+
+
+def _backfill_comic(name):
+    url_next, pages = database_read_single("SELECT url_next, pages FROM backfill WHERE name = ?", name) or (None, 0)
+    if url_next is None:
+        # Only the comics not done yet are backfilled, so the frontier just hasn't been found yet
+        url_next = _backfill_url_start(name)
+        with database_transaction() as transaction:
+            transaction.execute("INSERT OR IGNORE INTO backfill (name) VALUES (?)", name)
+            transaction.execute("UPDATE backfill SET url_next = ? WHERE name = ?", url_next, name)
+    logger.info(f"Backfilling {name} from {url_next} after {pages} pages")
+
+    while url_next is not None:
+        page = _fetch_comic_page(url_next)
+        date_str = page['date'].strftime(r"%Y-%m-%d")
+        # The strip and the new frontier are committed together, so no page is ever skipped
+        inserted = False
+        with database_transaction() as transaction:
+            if database_read_single("SELECT 1 FROM images WHERE name = ? AND date = ?", name, date_str) is None:
+                filepath = __download_comic_image(page['image_url'])
+                transaction.execute(
+                    "INSERT OR IGNORE INTO images (name, date, filepath, url, rendition) values (?, ?, ?, ?, ?)",
+                    name, date_str, filepath, page['url'], _rendition(filepath))
+                inserted = True
+            transaction.execute(
+                "UPDATE backfill SET url_next = ?, date_oldest = ?, pages = pages + 1, done = ?, failures = 0 "
+                "WHERE name = ?",
+                page['url_previous'], date_str, page['url_previous'] is None, name)
+        if inserted:
+            # The strip can be picked at random right away
+            with image_ids_lock:
+                image_ids.pop(name, None)
+
+        url_next = page['url_previous']
+        pages += 1
+        metrics.increment("rubus_backfill_pages_total", name=name)
+        if pages % BACKFILL_LOG_INTERVAL_PAGES == 0:
+            logger.info(f"Backfilled {pages} pages of {name} back to {date_str}")
+        time.sleep(BACKFILL['interval_seconds'])
+
+    logger.info(f"Backfill of {name} complete after {pages} pages")
+
+
+def _backfill_url_start(name):
+    """URL of the oldest indexed strip of the comic or the latest one if it isn't known"""
+    url_oldest = database_read_single("SELECT url FROM images WHERE name = ? ORDER BY date LIMIT 1", name)
+    if url_oldest is not None:
+        return url_oldest
+
+    # Strips indexed before their URLs were stored can only be skipped over starting from the latest one
+    return _fetch_comic_url_latest(database_read_single("SELECT url FROM sources WHERE name = ?", name))
+
+
+def _is_page_indexed(url):
+    return database_read_single("SELECT 1 FROM images WHERE url = ?", url) is not None
 
 
 def _start(update, context):  # pylint: disable=unused-argument
     """Present the user all available options"""
     keyboard = [
         [InlineKeyboardButton("Post a random comic", callback_data=Command.RANDOM_MENU)],
+        [InlineKeyboardButton("Browse the archive of a comic", callback_data=Command.BROWSE_MENU)],
         [InlineKeyboardButton("Change the schedule of a daily comic", callback_data=Command.SCHEDULE_MENU)],
         [InlineKeyboardButton("Cancel", callback_data=Command.CANCEL)],
     ]
@@ -139,48 +381,183 @@ def _start(update, context):  # pylint: disable=unused-argument
 
 def _random_menu(update, context):  # pylint: disable=unused-argument
     """Present the user the comic options"""
-    comics = database_query("SELECT name FROM sources")
-    buttons = [InlineKeyboardButton(f"{name}", callback_data=name) \
-        for name in itertools.chain.from_iterable(comics)]
+    if _not_ready(update):
+        return ConversationHandler.END
+
+    query = update.callback_query
+    query.message.edit_text("Select option:", reply_markup=_sources_keyboard())
+    return State.RANDOM
+
+
+def _browse_menu(update, context):  # pylint: disable=unused-argument
+    """Present the user the comics to browse"""
+    if _not_ready(update):
+        return ConversationHandler.END
+
+    query = update.callback_query
+    query.message.edit_text("Select option:", reply_markup=_sources_keyboard())
+    return State.BROWSE_SELECT
+
+
+def _sources_keyboard():
+    buttons = [InlineKeyboardButton(f"{name}", callback_data=name) for name in _sources()]
     buttons_grouped = helper.group_elements(buttons, 2)
     keyboard = [
         *buttons_grouped,
         [InlineKeyboardButton("Cancel", callback_data=Command.CANCEL)],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _browse_keyboard(rowid):
+    keyboard = [
+        [
+            InlineKeyboardButton("Older", callback_data=f"{CALLBACK_PREFIX_BROWSE}{rowid}:older"),
+            InlineKeyboardButton("Newer", callback_data=f"{CALLBACK_PREFIX_BROWSE}{rowid}:newer"),
+        ],
+        [InlineKeyboardButton("Close", callback_data=CALLBACK_BROWSE_CLOSE)],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@helper.run_async
+@metrics.timed('handler')
+def _browse_start(update, context):
+    """Post the latest strip of the selected comic with the buttons for browsing its archive
+
+    The browsing itself happens outside of the conversation, which ends here.
+    """
     query = update.callback_query
-    query.message.edit_text("Select option:", reply_markup=reply_markup)
-    return State.RANDOM
+    query.answer()
+    name = query.data
+
+    image = database_read_single(
+        "SELECT rowid, date, COALESCE(rendition, filepath), file_id FROM images WHERE name = ? "
+        "ORDER BY date DESC LIMIT 1", name)
+    if image is None:
+        query.message.edit_text(f"No {name} comics available yet")
+        return ConversationHandler.END
+
+    rowid, date, filepath, file_id = image
+    query.message.edit_text(f"Browsing {name}")
+    _send_comic(
+        context.bot, query.message.chat_id, name, date, filepath, file_id, f"{name} of {date}",
+        reply_markup=_browse_keyboard(rowid))
+    return ConversationHandler.END
+
+
+@helper.run_async
+@metrics.timed('handler')
+def _browse_step(update, context):
+    """Replace the posted strip with the next older or newer one of the same comic"""
+    query = update.callback_query
+    rowid, direction = query.data[len(CALLBACK_PREFIX_BROWSE):].split(':')
+
+    image = database_read_single(STATEMENTS_BROWSE[direction], int(rowid))
+    if image is None:
+        query.answer(f"No {direction} strips available")
+        return
+
+    rowid, name, date, filepath, file_id = image
+    caption = f"{name} of {date}"
+    try:
+        with contextlib.ExitStack() as stack:
+            media = InputMediaPhoto(
+                file_id if file_id is not None else stack.enter_context(open(filepath, 'rb')), caption=caption)
+            message = context.bot.edit_message_media(
+                query.message.chat_id, query.message.message_id, media=media, reply_markup=_browse_keyboard(rowid))
+    except TelegramError:
+        logger.exception(f"Failed to show {caption} while browsing")
+        query.answer("Unable to show the strip, please try again")
+        return
+
+    if file_id is None:
+        _file_id_store(message, name, date)
+    query.answer()
+
+
+def _browse_close(update, context):  # pylint: disable=unused-argument
+    """Stop browsing and leave the current strip in place"""
+    query = update.callback_query
+    query.answer()
+    query.edit_message_reply_markup(reply_markup=None)
 
 
+@helper.run_async
+@metrics.timed('handler')
 def _random_post(update, context):
     """Post a random comic"""
     query = update.callback_query
     name = query.data
 
-    date, filepath, file_id = database_query_single(
-        "SELECT date, filepath, file_id FROM images WHERE name = ? ORDER BY RANDOM() LIMIT 1", name)
+    image_id = _random_image_id(context.chat_data, name)
+    if image_id is None:
+        query.message.edit_text(f"No {name} comics available yet")
+        return ConversationHandler.END
+
+    date, filepath, file_id = database_read_single(
+        "SELECT date, COALESCE(rendition, filepath), file_id FROM images WHERE rowid = ?", image_id)
 
     query.message.edit_text(f"{name} of {date}")
     chat_id = query.message.chat['id']
-
-    if file_id is not None:
-        context.bot.send_photo(chat_id, file_id)
-    else:
-        with open(filepath, 'rb') as image:
-            context.bot.send_photo(chat_id, image)
+    _send_comic(context.bot, chat_id, name, date, filepath, file_id)
 
     return ConversationHandler.END
 
 
+def _image_ids(name):
+    with image_ids_lock:
+        ids = image_ids.get(name)
+    if ids is None:
+        ids = [row[0] for row in database_read("SELECT rowid FROM images WHERE name = ? ORDER BY rowid", name)]
+        with image_ids_lock:
+            image_ids[name] = ids
+    return ids
+
+
+@functools.lru_cache(maxsize=32)
+def _image_ids_shuffled(name, seed, count):
+    # Images are never deleted so the first count ids always stay the same
+    ids = _image_ids(name)[:count]
+    random.Random(seed).shuffle(ids)
+    return ids
+
+
+def _random_image_id(chat_data, name):
+    """Pick a random image of the comic which hasn't been yet posted to the chat
+
+    Each chat goes through a shuffled order of all the images of a comic before any repeats.
+    Only the seed of the order and the position in it are stored in the chat_data.
+    Images indexed in the middle of the order are included once the next order begins.
+    """
+    ids = _image_ids(name)
+    if not ids:
+        return None
+
+    orders = chat_data.setdefault('comics_random', {})
+    order = orders.get(name)
+    # The order outlives restarts in the chat_data, so the comic may since have fewer images, e.g. after
+    # the database has been rebuilt
+    if order is None or order['position'] >= order['count'] or order['count'] > len(ids):
+        order = {'seed': random.getrandbits(32), 'position': 0, 'count': len(ids)}
+        orders[name] = order
+
+    image_id = _image_ids_shuffled(name, order['seed'], order['count'])[order['position']]
+    order['position'] += 1
+    return image_id
+
+
 def _schedule_menu(update, context):  # pylint: disable=unused-argument
     """Present the user the scheduling options"""
+    if _not_ready(update):
+        return ConversationHandler.END
+
     chat_id = update.callback_query.message.chat_id
-    comics = database_query("SELECT name FROM sources")
+    subscriptions = _subscriptions(chat_id)
 
     buttons = []
-    for name in itertools.chain.from_iterable(comics):
-        if _is_comic_scheduled(chat_id, name):
+    for name in _sources():
+        if name in subscriptions:
             text = f"Stop posting {name} daily at noon"
         else:
             text = f"Start posting {name} daily at noon"
@@ -196,127 +573,329 @@ def _schedule_menu(update, context):  # pylint: disable=unused-argument
     return State.SCHEDULE
 
 
+@helper.run_async
+@metrics.timed('handler')
 def _schedule_post(update, context):  # pylint: disable=unused-argument
     """Change the schedule of a comic"""
     query = update.callback_query
     chat_id = query.message.chat_id
     name = query.data
 
-    if _is_comic_scheduled(chat_id, name):
+    subscriptions = _subscriptions(chat_id)
+    if name in subscriptions:
         database_query("DELETE FROM daily_posts WHERE chat_id = ? AND name = ?", chat_id, name)
+        with cache_lock:
+            subscriptions.discard(name)
         query.message.edit_text(f"Scheduled {name} posting disabled")
     else:
-        database_query("INSERT INTO daily_posts values (?, ?)", chat_id, name)
+        database_query("INSERT OR IGNORE INTO daily_posts values (?, ?)", chat_id, name)
+        with cache_lock:
+            subscriptions.add(name)
         query.message.edit_text(f"Scheduled {name} posting enabled at noon")
 
     return ConversationHandler.END
 
 
-def _is_comic_scheduled(chat_id, name):
-    row = database_query_single("SELECT 1 FROM daily_posts WHERE chat_id = ? AND name = ?", chat_id, name)
-    return row is not None
+def _not_ready(update):
+    """Tell the user to come back later if no comics are known before the first index is done"""
+    if ready.is_set() or _sources():
+        return False
+
+    update.callback_query.message.edit_text("The comics are still being indexed, try again in a moment")
+    return True
+
+
+def _sources_refresh():
+    names = [name for (name,) in database_read("SELECT name FROM sources")]
+    with cache_lock:
+        cache['sources'] = names
+    return names
+
+
+def _sources():
+    """Names of all the comics available"""
+    with cache_lock:
+        names = cache['sources']
+    if names is None:
+        names = _sources_refresh()
+    return names
+
+
+def _subscriptions(chat_id):
+    """Set of the comics posted daily to the chat
+
+    The set is shared with the cache, so it must only be modified while holding cache_lock.
+    """
+    with cache_lock:
+        subscriptions = cache['subscriptions'].get(chat_id)
+    if subscriptions is None:
+        rows = database_read("SELECT name FROM daily_posts WHERE chat_id = ?", chat_id)
+        with cache_lock:
+            subscriptions = cache['subscriptions'].setdefault(chat_id, {name for (name,) in rows})
+    return subscriptions
 
 
+@metrics.timed('job')
 def _post_comic_of_the_day(context):
     """Post the latest available comic if one is available
 
     Automatically go through all registered chats and stored comics.
+    The comics of each chat are sent together as albums to save API calls and notifications.
     """
+    time_start = time.monotonic()
     today_str = datetime.date.today().strftime(r"%Y-%m-%d")
+    chats, file_ids = _daily_plan(today_str)
+
+    def deliveries_of_chat(chat_id):
+        comics = [(name, filepath, file_ids.get(name)) for name, filepath in chats[chat_id]]
+        return [
+            delivery.Delivery(chat_id, functools.partial(
+                _send_comics, context.bot, chat_id, today_str, album, disable_notification=True))
+            for album in helper.group_elements(comics, MEDIA_GROUP_SIZE_MAX)
+        ]
 
-    for chat_id, name in database_query("SELECT chat_id, name FROM daily_posts"):
-        filepath = database_query_single(
-            "SELECT filepath FROM images "
-            "WHERE name = ? AND date = ? ORDER BY date DESC LIMIT 1", name, today_str)
-
-        if filepath is None:
+    # Upload every comic not yet known by Telegram once by serving the chats in need of them one at a time,
+    # after which all the remaining chats can be sent the file_ids in parallel
+    results = []
+    uploaders = set()
+    for chat_id, comics in chats.items():
+        if all(name in file_ids for name, _ in comics):
             continue
+        uploaders.add(chat_id)
+        for result in delivery.deliver(deliveries_of_chat(chat_id)):
+            results.append(result)
+            file_ids.update(result or {})
+
+    deliveries = [item for chat_id in chats if chat_id not in uploaders for item in deliveries_of_chat(chat_id)]
+    results.extend(delivery.deliver(deliveries))
+
+    delivered = sum(len(result) for result in results if result is not None)
+    total = sum(len(comics) for comics in chats.values())
+    logger.info(
+        f"Delivered {delivered}/{total} daily comics to {len(chats)} chats in {time.monotonic() - time_start:.1f} s")
+
+
+def _daily_plan(date):
+    """Comics of the date to post to each chat as (name, filepath) and the file_ids already known by name"""
+    plan = database_read(
+        "SELECT daily_posts.chat_id, images.name, COALESCE(images.rendition, images.filepath), images.file_id "
+        "FROM daily_posts JOIN images ON images.name = daily_posts.name WHERE images.date = ? "
+        "ORDER BY daily_posts.chat_id, images.name", date)
+
+    chats = collections.defaultdict(list)
+    file_ids = {}
+    for chat_id, name, filepath, file_id in plan:
+        chats[chat_id].append((name, filepath))
+        if file_id is not None:
+            file_ids[name] = file_id
+    return chats, file_ids
+
+
+def _send_comics(bot, chat_id, date, comics, **kwargs):
+    """Send the comics of the day as an album or as a single photo if there is only one
+
+    The comics are given as (name, filepath, file_id) tuples, at most MEDIA_GROUP_SIZE_MAX of them.
+    If Telegram rejects the album, the comics are sent one by one instead.
+    Returns the file_ids of the comics by their name.
+    """
+    if len(comics) > 1:
+        try:
+            return _send_media_group(bot, chat_id, date, comics, **kwargs)
+        except BadRequest:
+            # Any other error, e.g. a timeout, is left to the delivery, as the album may have arrived anyway
+            logger.exception(f"Album rejected by {chat_id}, sending the comics one by one")
+
+    return {
+        name: _send_comic(bot, chat_id, name, date, filepath, file_id, f"{name} of the day", **kwargs)
+        for name, filepath, file_id in comics
+    }
 
-        with open(filepath, 'rb') as image:
-            context.bot.send_photo(chat_id, image, f"{name} of the day", disable_notification=True)
 
+def _send_media_group(bot, chat_id, date, comics, **kwargs):
+    """Send the comics as an album, uploading only the ones Telegram doesn't already have"""
+    with contextlib.ExitStack() as stack:
+        media = [
+            InputMediaPhoto(
+                file_id if file_id is not None else stack.enter_context(open(filepath, 'rb')),
+                caption=f"{name} of the day")
+            for name, filepath, file_id in comics
+        ]
+        messages = bot.send_media_group(chat_id, media, **kwargs)
 
-def _download_comic(url):
-    """Download the comic from a given URL
+    file_ids = {}
+    for (name, _, file_id), message in zip(comics, messages):
+        if file_id is None:
+            file_id = _file_id_store(message, name, date)
+        file_ids[name] = file_id
+    return file_ids
 
-    Returns a dictionary with the relevant data.
+
+def _send_comic(bot, chat_id, name, date, filepath, file_id, caption=None, **kwargs):  # pylint: disable=too-many-arguments
+    """Send the image of a comic, uploading it only if Telegram doesn't already have it
+
+    After the first upload the file_id given by Telegram is stored so any later sends
+    to any chat can refer to the same file instead. Returns the file_id of the image.
+    """
+    if file_id is not None:
+        bot.send_photo(chat_id, file_id, caption, **kwargs)
+        return file_id
+
+    with open(filepath, 'rb') as image:
+        message = bot.send_photo(chat_id, image, caption, **kwargs)
+    return _file_id_store(message, name, date)
+
+
+def _file_id_store(message, name, date):
+    """Store the file_id of the comic uploaded in the message, returns the file_id"""
+    # The sizes are ordered from the smallest to the largest, which matches the original upload
+    file_id = message.photo[-1].file_id
+    database_query("UPDATE images SET file_id = ? WHERE name = ? AND date = ?", file_id, name, date)
+    return file_id
+
+
+def _render(filepath, directory):
+    """Re-encode the image as a JPEG no larger than RENDITION_DIMENSION_MAX_PIXELS in either dimension
+
+    Runs in the rendition pool. Returns the filepath of the rendition stored in the directory
+    or the original filepath if re-encoding wouldn't make the image any smaller.
+    """
+    image = Image.open(filepath)
+    # A JPEG can already be scaled down by a power of two while decoding
+    image.draft('RGB', (RENDITION_DIMENSION_MAX_PIXELS, RENDITION_DIMENSION_MAX_PIXELS))
+    image = image.convert('RGB')
+    image.thumbnail((RENDITION_DIMENSION_MAX_PIXELS, RENDITION_DIMENSION_MAX_PIXELS), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=RENDITION_JPEG_QUALITY, optimize=True, progressive=True)
+    if buffer.tell() >= os.path.getsize(filepath):
+        return filepath
+    return storage.store_bytes(directory, buffer.getvalue(), ".jpg")
+
+
+def _rendition(filepath):
+    """Create the rendition of the image for uploading, returns None if that fails
+
+    The conversion is CPU bound, so it is run in the rendition pool to avoid holding the GIL.
     """
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, 'html.parser')
+    return _rendition_result(filepath, rendition_pool.submit(_render, filepath, IMAGES_DIRECTORY))
 
-    date_text_with_day_of_week = soup.find('span', {'class': 'date'}).text
-    date_text = date_text_with_day_of_week.split(' ')[-1]
+
+def _rendition_result(filepath, future):
     try:
-        date = datetime.datetime.strptime(date_text, r"%d.%m.%Y").date()
-    except ValueError:
-        # Comics released in the current year don't include the year by default in the text
-        today = datetime.datetime.now().date()
-        date_text = f"{date_text}{today.year}"
-        date = datetime.datetime.strptime(date_text, r"%d.%m.%Y").date()
-
-    image_element = soup.find('img')
-    # The element includes a low-res and high-res partial URI but we want only the high-res one,
-    # which is in the attribute 'data-srcset' in the format "<link> 1920w"
-    image_uri = image_element['data-srcset'].rstrip(" 1920w")
-    # image_uri is of format '//hs.mediadelivery.fi/...'
-    image_url = f"https:{image_uri}"
-    image_filepath = __download_comic_image(image_url)
-
-    data = {
-        'date': date,
-        'filepath': image_filepath,
+        rendition = future.result()
+    except Exception:  # pylint: disable=broad-except
+        # The rendition is only an optimization, the original can still be uploaded as is
+        logger.exception(f"Failed to create a rendition of {filepath}")
+        return None
+
+    size_original, size_rendition = os.path.getsize(filepath), os.path.getsize(rendition)
+    metrics.increment("rubus_rendition_bytes_saved_total", size_original - size_rendition)
+    logger.debug(f"Rendition of {filepath} is {size_rendition} bytes instead of {size_original}")
+    return rendition
+
+
+def _renditions_create_missing():
+    """Create the renditions of the images indexed before the renditions were introduced"""
+    missing = database_read("SELECT rowid, filepath FROM images WHERE rendition IS NULL")
+    if not missing:
+        return
+
+    logger.info(f"Creating renditions of {len(missing)} images")
+    for batch in helper.group_elements(missing, RENDITION_BATCH_SIZE):
+        # The whole batch is queued at once to keep every process of the pool busy
+        futures = [(rowid, filepath, rendition_pool.submit(_render, filepath, IMAGES_DIRECTORY))
+                   for rowid, filepath in batch]
+        renditions = [(_rendition_result(filepath, future), rowid) for rowid, filepath, future in futures]
+        database_query_many(
+            "UPDATE images SET rendition = ? WHERE rowid = ?",
+            [(rendition, rowid) for rendition, rowid in renditions if rendition is not None])
+    logger.info("Renditions created")
+
+
+def _host_limit(url):
+    host = urllib.parse.urlsplit(url).hostname
+    with host_limits_lock:
+        if host not in host_limits:
+            host_limits[host] = threading.BoundedSemaphore(CRAWLER['connections_per_host'])
+        return host_limits[host]
+
+
+def _http_observe(url, time_start, size):
+    host = urllib.parse.urlsplit(url).hostname
+    metrics.observe("rubus_http_request_duration_seconds", time.perf_counter() - time_start, host=host)
+    metrics.increment("rubus_http_response_bytes_total", size, host=host)
+
+
+def _http_get(url):
+    """GET the URL using the shared session within the limits of its host"""
+    with _host_limit(url):
+        time_start = time.perf_counter()
+        response = session.get(url, timeout=CRAWLER['timeout_seconds'])
+    _http_observe(url, time_start, len(response.content))
+    response.raise_for_status()
+    return response
+
+
+def _fetch_comic_page(url):
+    """Fetch the metadata of the comic from a given URL without downloading the image
+
+    Returns a dictionary with the relevant data.
+    """
+    response = _http_get(url)
+    data = parsing.comic_page(response.content)
+
+    if data['uri_previous'] is None:
+        url_previous = None
+    else:
+        url_previous = urllib.parse.urlunsplit((URL_SCHEME, URL_HOST, data['uri_previous'], "", ""))
+
+    return {
+        'url': url,
+        'date': data['date'],
+        'image_url': data['image_url'],
+        'url_previous': url_previous,
     }
-    return data
 
 
 def __download_comic_image(image_url):
-    response = requests.get(image_url)
-    image_data = response.content
-    # Save the image locally with the same filename as the host server is using.
-    image_filename = os.path.basename(image_url.split('/')[-1])
-    image_filepath = os.path.join(CONFIG['filepaths']['storage'], image_filename)
-    with open(image_filepath, 'wb') as image_file:
-        image_file.write(image_data)
-    return image_filepath
+    # Keep the extension used by the host server, the name is defined by the content
+    extension = os.path.splitext(urllib.parse.urlsplit(image_url).path)[1]
+    # The host limit is held until the whole image has been streamed to disk
+    with _host_limit(image_url):
+        time_start = time.perf_counter()
+        with session.get(image_url, stream=True, timeout=CRAWLER['timeout_seconds']) as response:
+            response.raise_for_status()
+            chunks = response.iter_content(storage.CHUNK_SIZE_BYTES)
+            filepath = storage.store_stream(IMAGES_DIRECTORY, chunks, extension)
+    _http_observe(image_url, time_start, os.path.getsize(filepath))
+    return filepath
 
 
 def _fetch_comics_available():
     """Fetch all available comics from the frontpage at URL_COMICS"""
-    response = requests.get(URL_COMICS)
-    soup = BeautifulSoup(response.content, 'html.parser')
-
-    comic_data = []
-    comic_contents = soup.find_all('div', {'class': 'cartoon-content'})
-    for content in comic_contents:
-        name = content.find('span', {'class': 'title'}).get_text()
-        uri_part = content.find('meta', {'itemprop': 'contentUrl'})['content']
-        url = f"{URL_BASE}{uri_part}"
-        comic_data.append({'name': name, 'url': url})
-    return comic_data
-
-
-def _fetch_comic_url_all(url_current):
-    # Fake the first one to be of the same form without the base part
-    uri_previous_part = {'href': url_current[len(URL_BASE):]}
-    while uri_previous_part is not None:
-        url_current = urllib.parse.urlunsplit(
-            (URL_SCHEME, URL_HOST, uri_previous_part['href'], "", "")
-        )
-        yield url_current
-
-        response = requests.get(url_current)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # Crawl backwards using the "Previous" button on the page
-        uri_previous_part = soup.find('a', {'class': 'article-navlink prev'})
+    response = _http_get(URL_COMICS)
+    return [
+        {'name': comic['name'], 'url': f"{URL_BASE}{comic['uri']}"}
+        for comic in parsing.comics_available(response.content)
+    ]
+
+
+def _fetch_comic_pages(url_current, is_known):
+    """Crawl backwards from url_current yielding the metadata of each page
+
+    The crawl stops before fetching the first page for which is_known(url) is true.
+    """
+    while url_current is not None and not is_known(url_current):
+        page = _fetch_comic_page(url_current)
+        yield page
+        url_current = page['url_previous']
 
 
 def _fetch_comic_url_latest(comic_url_homepage):
     """Fetch URL of the latest comic from its individual page"""
-    response = requests.get(comic_url_homepage)
-    soup = BeautifulSoup(response.content, 'html.parser')
-    latest_comic = soup.find('figure')
+    response = _http_get(comic_url_homepage)
     # Grab the link for the individual page of the comic as we can start crawling from that
-    comic_uri_part = latest_comic.find('meta', {'itemprop': 'contentUrl'})['content']
+    comic_uri_part = parsing.comic_uri_latest(response.content)
     comic_url = f"{URL_BASE}{comic_uri_part}"
     return comic_url
 
@@ -327,6 +906,7 @@ handler_conversation = ConversationHandler(
         State.MENU: [
             CallbackQueryHandler(_random_menu, pattern=f"^{Command.RANDOM_MENU}$"),
             CallbackQueryHandler(_schedule_menu, pattern=f"^{Command.SCHEDULE_MENU}$"),
+            CallbackQueryHandler(_browse_menu, pattern=f"^{Command.BROWSE_MENU}$"),
             CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
             ],
         State.SCHEDULE: [
@@ -336,7 +916,17 @@ handler_conversation = ConversationHandler(
         State.RANDOM: [
             CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
             CallbackQueryHandler(_random_post),
-        ]
+        ],
+        State.BROWSE_SELECT: [
+            CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
+            CallbackQueryHandler(_browse_start),
+        ],
     },
     fallbacks=[MessageHandler(Filters.all, helper.confused)]
 )
+
+# Must be added before the conversations, as their catch-all handlers would take the buttons otherwise
+handlers_browse = [
+    CallbackQueryHandler(_browse_step, pattern=f"^{CALLBACK_PREFIX_BROWSE}[0-9]+:(older|newer)$"),
+    CallbackQueryHandler(_browse_close, pattern=f"^{CALLBACK_BROWSE_CLOSE}$"),
+]
@@ -0,0 +1,92 @@
+"""
+Deliver messages to multiple chats in parallel within the Telegram rate limits.
+
+Telegram allows a bot to send roughly 30 messages per second in total
+but only about one message per second to a single chat.
+"""
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from telegram.error import RetryAfter, TelegramError
+
+from rubus import helper
+
+
+logger = logging.getLogger(__name__)
+
+CONFIG = helper.config_load()['delivery']
+
+# A Delivery is a single Bot API request to chat_id, which send performs when called
+Delivery = collections.namedtuple('Delivery', ['chat_id', 'send'])
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    """Space out events shared between multiple threads to the given rate"""
+    def __init__(self, rate_per_second):
+        self.interval = 1 / rate_per_second
+        self.time_next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next event is allowed"""
+        with self.lock:
+            time_now = time.monotonic()
+            time_slot = max(time_now, self.time_next)
+            self.time_next = time_slot + self.interval
+        time.sleep(time_slot - time_now)
+
+
+def _send_with_retry(delivery, limiter):
+    for attempt in range(1, CONFIG['attempts'] + 1):
+        limiter.wait()
+        try:
+            return delivery.send()
+        except RetryAfter as exception:
+            if attempt == CONFIG['attempts']:
+                # Waiting would only delay the failure
+                break
+            logger.warning(f"Flood control towards {delivery.chat_id}, retrying in {exception.retry_after} s")
+            time.sleep(exception.retry_after)
+
+    raise TelegramError(f"Delivery to {delivery.chat_id} failed after {CONFIG['attempts']} attempts")
+
+
+def _deliver_to_chat(deliveries, limiter):
+    """Run the deliveries of a single chat in order with the per chat interval in between"""
+    results = []
+    for index, delivery in enumerate(deliveries):
+        if index:
+            time.sleep(CONFIG['chat_interval_seconds'])
+        try:
+            results.append(_send_with_retry(delivery, limiter))
+        except Exception:  # pylint: disable=broad-except
+            # Whatever went wrong, the rest of the chats must still get their deliveries
+            logger.exception(f"Failed to deliver to {delivery.chat_id}")
+            results.append(None)
+    return results
+
+
+def deliver(deliveries):
+    """Run all the deliveries in parallel between the chats
+
+    Returns the results of the send callables in the same order as the deliveries,
+    with None for any which failed.
+    """
+    limiter = RateLimiter(CONFIG['messages_per_second'])
+    chats = collections.defaultdict(list)
+    for index, delivery in enumerate(deliveries):
+        chats[delivery.chat_id].append((index, delivery))
+
+    results = [None] * len(deliveries)
+    with concurrent.futures.ThreadPoolExecutor(CONFIG['workers'], thread_name_prefix="delivery") as executor:
+        futures = {
+            executor.submit(_deliver_to_chat, [delivery for _, delivery in items], limiter): items
+            for items in chats.values()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            for (index, _), result in zip(futures[future], future.result()):
+                results[index] = result
+    return results
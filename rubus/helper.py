@@ -2,21 +2,30 @@
 General helper functions which can be shared between multiple modules.
 """
 import collections
+import concurrent.futures
+import concurrent.futures.process
+import functools
 import importlib.resources
 import json
 import logging
 import sqlite3
+import threading
+import time
+import urllib.parse
 
-from telegram.ext import ConversationHandler
+from telegram import Update
+from telegram.ext import ConversationHandler, Dispatcher
 
 
-logger = logging.getLogger('rubus')
+logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
 def config_load():
     """Load stored configuration from disk
 
     Configuration should be stored as JSON along with the module files.
+    It is only read once, so the returned dictionary is shared and must not be modified.
 
     :return: Dictionary of the configuration
     """
@@ -25,6 +34,54 @@ def config_load():
     return data
 
 
+# Bounds the amount of handler calls waiting for a free thread in the Dispatcher pool
+async_pending = threading.BoundedSemaphore(config_load()['dispatcher']['async_pending_max'])
+
+
+def run_async(func):
+    """Decorator for running a handler in the Dispatcher thread pool like telegram.ext.run_async
+
+    Once the amount of pending calls reaches its bound the Dispatcher will wait for a free slot
+    before handling more updates. The updates then wait at Telegram instead of piling up here.
+
+    A ConversationHandler will switch to the returned state once the call has finished.
+    The Dispatcher persists the user_data and chat_data before the call has even started,
+    so they are persisted once more after it for the changes made by the handler.
+    """
+    @functools.wraps(func)
+    def async_func(update, context, *args, **kwargs):
+        async_pending.acquire()
+        dispatcher = Dispatcher.get_instance()
+
+        def run_and_release():
+            try:
+                return func(update, context, *args, **kwargs)
+            finally:
+                _persist(dispatcher, update)
+                async_pending.release()
+
+        return dispatcher.run_async(run_and_release)
+
+    return async_func
+
+
+def _persist(dispatcher, update):
+    """Write the user_data and chat_data of the update like the Dispatcher does after each update"""
+    if dispatcher.persistence is None or not isinstance(update, Update):
+        return
+
+    try:
+        if dispatcher.persistence.store_chat_data and update.effective_chat:
+            chat_id = update.effective_chat.id
+            dispatcher.persistence.update_chat_data(chat_id, dispatcher.chat_data[chat_id])
+        if dispatcher.persistence.store_user_data and update.effective_user:
+            user_id = update.effective_user.id
+            dispatcher.persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+    except Exception:  # pylint: disable=broad-except
+        # The data stays in memory and is written again with the next update
+        logger.exception("Failed to persist the data changed by an asynchronous handler")
+
+
 def cancel(update, context):  # pylint: disable=unused-argument
     """Handler for canceling current operation in ConversationHandler
 
@@ -61,46 +118,207 @@ def group_elements(flat_list, amount_per_group):
     return grouped
 
 
+class TTLCache:
+    """Thread-safe least recently used cache where the entries also expire after ttl_seconds
+
+    Counts the hits and misses for judging whether the cache is worth it.
+    """
+    def __init__(self, maxsize, ttl_seconds):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value if it is stored and not expired yet"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store the value, evicting the least recently used one if the cache is full"""
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove the value if it is stored"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class ProcessPool:  # pylint: disable=too-few-public-methods
+    """Process pool started on the first submit and replaced once any of its processes has died
+
+    CPU bound work is run in separate processes to avoid holding the GIL from the other threads.
+    A process killed e.g. for running out of memory breaks the whole pool, which then fails
+    the pending futures with BrokenProcessPool, but the next submit starts a fresh pool.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """Schedule func(*args) to be run in a worker process, returns a Future"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            pool = self.pool
+
+        future = pool.submit(func, *args)
+        future.add_done_callback(functools.partial(self._discard_if_broken, pool))
+        return future
+
+    def _discard_if_broken(self, pool, future):
+        if future.cancelled() or not isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+            return
+
+        with self.lock:
+            if self.pool is pool:
+                logger.warning("A process of the pool has died, starting a new pool for the next submit")
+                self.pool = None
+
+
 # Queue objects will be used for ensuring for multi-thread communications to
-# ensure that only a single thread is accessing the database to avoid errors.
-Query = collections.namedtuple('Query', ['statement', 'args'])
-Result = collections.namedtuple('Result', ['statement', 'args', 'rows'])
+# ensure that only a single thread is writing to the database to avoid errors.
+# Every Query carries its own reply slot so the rows always find their way back
+# to the thread which submitted the query, no matter how many are waiting.
+Query = collections.namedtuple('Query', ['statement', 'args', 'reply'])
+# A Batch is executed by the worker as a single transaction, which is either
+# fully committed or rolled back. Each Statement is run once per set of args.
+Batch = collections.namedtuple('Batch', ['statements', 'reply'])
+Statement = collections.namedtuple('Statement', ['statement', 'args_many'])
+
 
+def database_worker(database_filepath, queries, observe=None):
+    """All database writes should be submitted through this worker
 
-def database_worker(database_filepath, queries, results):
-    """All database queries should be submitted through this worker"""
+    If given, observe is called with the duration of each query in seconds.
+    """
     logger.debug(f"Connecting to {database_filepath}")
     # Set isolation_level=None for autocommit mode as we are running the
     # database through a single thread, thus making db management easier.
     conn = sqlite3.connect(database_filepath, isolation_level=None)
+    # Write-ahead logging allows the read-only connections to run in parallel with the writer
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     while True:
         query = queries.get()
 
+        time_start = time.perf_counter()
         try:
-            rows = cursor.execute(query.statement, query.args).fetchall()
-            results.put(Result(query.statement, query.args, rows))
-        except (sqlite3.OperationalError, sqlite3.ProgrammingError):
+            if isinstance(query, Batch):
+                _execute_batch(cursor, query.statements)
+                rows = []
+            else:
+                rows = cursor.execute(query.statement, query.args).fetchall()
+            query.reply.set_result(rows)
+        except sqlite3.Error as exception:
             logger.exception("SQLite exception during transaction!")
-            results.put(None)
+            query.reply.set_exception(RuntimeError(f"Error in transaction: {exception}"))
+        if observe is not None:
+            observe(time.perf_counter() - time_start)
+
 
+def _execute_batch(cursor, statements):
+    cursor.execute("BEGIN")
+    try:
+        for statement in statements:
+            cursor.executemany(statement.statement, statement.args_many)
+    except sqlite3.Error:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
 
-def database_query(queries, results, statement, *args):
+
+def database_query(queries, statement, *args):
     """Request a query from the database"""
-    queries.put(Query(statement, args))
+    reply = concurrent.futures.Future()
+    queries.put(Query(statement, args, reply))
     # Block while waiting for the results...
-    result = results.get()
-    if result is None:
-        raise RuntimeError("Error in transaction!")
-    return result.rows
+    return reply.result()
 
 
-def database_query_single(queries, results, statement, *args):
-    """Request query returning only a single row or element
+def database_query_many(queries, statement, args_many):
+    """Request the same statement to be run for every set of args in a single transaction"""
+    reply = concurrent.futures.Future()
+    queries.put(Batch([Statement(statement, list(args_many))], reply))
+    reply.result()
 
-    The caller is responsible of expecting what format is returned.
+
+class Transaction:
+    """Collect statements locally and submit them to the database_worker in one go
+
+    Use through database_transaction as a context manager. Nothing is sent to the worker
+    if the block raises, otherwise all statements are committed atomically on exit.
     """
-    rows = database_query(queries, results, statement, *args)
+    def __init__(self, queries):
+        self.queries = queries
+        self.statements = []
+
+    def execute(self, statement, *args):
+        """Add a statement to be run once with the given args"""
+        self.statements.append(Statement(statement, [args]))
+
+    def executemany(self, statement, args_many):
+        """Add a statement to be run once per each set of args"""
+        self.statements.append(Statement(statement, list(args_many)))
+
+    def commit(self):
+        """Submit the collected statements and block until they have been committed"""
+        if not self.statements:
+            return
+
+        reply = concurrent.futures.Future()
+        self.queries.put(Batch(self.statements, reply))
+        self.statements = []
+        reply.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+
+def database_transaction(queries):
+    """Start collecting statements to be committed as a single transaction"""
+    return Transaction(queries)
+
+
+def database_migrate(queries, migrations):
+    """Bring the database schema up to date
+
+    Migrations are given as a list where each element is a list of statements.
+    The position in the list defines the schema version, so existing migrations
+    must never be modified or reordered, only new ones appended.
+    Each migration is applied in its own transaction along with the version bump.
+    """
+    database_query(queries, "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version_current = database_query_single(queries, "SELECT MAX(version) FROM schema_version") or 0
+
+    for version, statements in enumerate(migrations[version_current:], start=version_current + 1):
+        logger.info(f"Migrating database schema to version {version}")
+        with database_transaction(queries) as transaction:
+            for statement in statements:
+                transaction.execute(statement)
+            transaction.execute("INSERT INTO schema_version (version) VALUES (?)", version)
+
+
+def _single(rows):
     if not rows:
         return None
 
@@ -111,3 +329,46 @@ def database_query_single(queries, results, statement, *args):
         return row[0]
 
     return row
+
+
+def database_query_single(queries, statement, *args):
+    """Request query returning only a single row or element
+
+    The caller is responsible of expecting what format is returned.
+    """
+    return _single(database_query(queries, statement, *args))
+
+
+def database_readers_connect(database_filepath, readers, amount):
+    """Open a pool of read-only connections into the readers Queue
+
+    The database must already exist, i.e. the database_worker has to be running
+    and at least one statement must have gone through it.
+    """
+    logger.debug(f"Opening {amount} read-only connections to {database_filepath}")
+    uri = f"file:{urllib.parse.quote(database_filepath)}?mode=ro"
+    for _ in range(amount):
+        # Each connection is used by one thread at a time, but not always the same one
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        readers.put(conn)
+
+
+def database_read(readers, statement, *args):
+    """Run a read-only query using any free connection from the readers pool
+
+    Never blocks behind the database_worker, as WAL mode lets readers see the latest
+    committed state while a write is in progress.
+    """
+    conn = readers.get()
+    try:
+        return conn.execute(statement, args).fetchall()
+    except sqlite3.Error as exception:
+        logger.exception("SQLite exception during read!")
+        raise RuntimeError(f"Error in read: {exception}") from exception
+    finally:
+        readers.put(conn)
+
+
+def database_read_single(readers, statement, *args):
+    """Read-only counterpart of database_query_single"""
+    return _single(database_read(readers, statement, *args))
@@ -0,0 +1,55 @@
+"""
+Logging pipeline keeping the I/O off the threads handling updates.
+
+The loggers only put the records into a queue, from which a single listener thread
+writes them to the stream and to a log file rotated by size.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+
+FORMAT_STREAM = "%(asctime)s.%(msecs)03d - %(levelname)s - %(module)s - %(message)s"
+FORMAT_STREAM_DATE = r"%Y-%m-%d %H:%M:%S"
+FORMAT_FILE = "%(asctime)s.%(msecs)03d - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a JSON object on a single line for log processing tools"""
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'line': record.lineno,
+            'thread': record.threadName,
+            # The QueueHandler has already merged any exception into the message
+            'message': record.getMessage(),
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def start(config, filepath):
+    """Route all logging through a queue to a listener thread and set the levels per logger
+
+    The configuration is the 'logging' section of config.json. Returns the QueueListener,
+    which should be stopped on exit to write out any remaining records.
+    """
+    handler_stream = logging.StreamHandler()
+    handler_stream.setFormatter(logging.Formatter(FORMAT_STREAM, datefmt=FORMAT_STREAM_DATE))
+
+    handler_file = logging.handlers.RotatingFileHandler(
+        filepath, maxBytes=config['file_max_bytes'], backupCount=config['file_backups'], encoding='utf-8')
+    handler_file.setFormatter(JsonFormatter() if config['json'] else logging.Formatter(FORMAT_FILE))
+
+    records = queue.Queue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(records))
+    for name, level in config['levels'].items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, handler_stream, handler_file)
+    listener.start()
+    return listener
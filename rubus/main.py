@@ -4,35 +4,31 @@ Main functionality of rubus for the time being.
 """
 import logging
 import os
+import socket
+import time
 
 import telegram.ext
+from telegram.error import TelegramError
 from telegram.ext import ConversationHandler
 from telegram.ext import CommandHandler, MessageHandler, Filters
 
 from rubus import comics
 from rubus import helper
+from rubus import logs
+from rubus import metrics
+from rubus import persistence
+from rubus import reminders
 from rubus import stickers
 
 
+CONFIG = helper.config_load()
 DOCKER_VOLUME_FILEPATH = "/data"
 FILEPATH_LOG = os.path.join(DOCKER_VOLUME_FILEPATH, "rubus.log")
-FILEPATH_DATA = os.path.join(DOCKER_VOLUME_FILEPATH, "bot-data.pkl")
+FILEPATH_DATA = os.path.join(DOCKER_VOLUME_FILEPATH, "bot-data.db")
+FILEPATH_DATA_PICKLE = os.path.join(DOCKER_VOLUME_FILEPATH, "bot-data.pkl")
+WEBHOOK_LISTEN_TIMEOUT_SECONDS = 10
 
-formatter_stream = logging.Formatter(
-    "%(asctime)s.%(msecs)03d - %(levelname)s - %(module)s - %(message)s",
-    datefmt=r"%Y-%m-%d %H:%M:%S")
-handler_stream = logging.StreamHandler()
-handler_stream.setFormatter(formatter_stream)
-
-formatter_file = logging.Formatter(
-    "%(asctime)s.%(msecs)03d - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s")
-handler_file = logging.FileHandler(FILEPATH_LOG, 'w')
-handler_file.setFormatter(formatter_file)
-
-logger = logging.getLogger('rubus')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(handler_stream)
-logger.addHandler(handler_file)
+logger = logging.getLogger('rubus.main')
 
 
 def start(update, context):  # pylint: disable=unused-argument
@@ -61,12 +57,93 @@ def error(update, context):  # pylint: disable=unused-argument
     logger.exception("Caught unhandled exception")
 
 
+def _start_updates(updater, api_token):
+    """Start receiving updates through a webhook if configured, otherwise by polling
+
+    Polling is used as a fallback if the webhook listener can't be started
+    or the webhook can't be registered to Telegram.
+    """
+    config = CONFIG['updates']
+    # Only Telegram should know the path, so the token is as good of a secret as any
+    if config['mode'] == 'webhook' and _start_webhook(updater, config['webhook'], url_path=api_token):
+        return
+
+    # Starting to poll also removes any webhook registered earlier
+    updater.start_polling(poll_interval=config['poll_interval_seconds'])
+    logger.info("Receiving updates by polling")
+
+
+def _start_webhook(updater, webhook, url_path):
+    """Start the webhook listener and register it to Telegram once it is up
+
+    Returns whether the updates are now received through the webhook.
+    """
+    if not webhook['url']:
+        logger.error("No public URL configured for the webhook, falling back to polling")
+        return False
+
+    # A listener failing to bind inside the Updater thread would stop the Dispatcher along with it
+    # for good, so the address is checked beforehand while polling is still an option
+    try:
+        with socket.create_server((webhook['listen'], webhook['port'])):
+            pass
+    except OSError:
+        logger.exception(f"Unable to listen at {webhook['listen']}:{webhook['port']}, falling back to polling")
+        return False
+
+    # TLS is expected to be terminated by a reverse proxy in front of the bot
+    updater.start_webhook(listen=webhook['listen'], port=webhook['port'], url_path=url_path)
+    if not _webhook_listening(updater):
+        # The Dispatcher has stopped with the listener, so there is no falling back anymore
+        updater.httpd = None
+        updater.stop()
+        raise RuntimeError(f"Webhook listener failed to start at {webhook['listen']}:{webhook['port']}")
+
+    try:
+        updater.bot.set_webhook(f"{webhook['url'].rstrip('/')}/{url_path}")
+    except TelegramError:
+        logger.exception("Unable to register the webhook, falling back to polling")
+        updater.stop()
+        return False
+
+    logger.info(f"Receiving updates through a webhook at port {webhook['port']}")
+    return True
+
+
+def _webhook_listening(updater):
+    """Wait for the webhook listener of the Updater to have bound its port"""
+    time_end = time.monotonic() + WEBHOOK_LISTEN_TIMEOUT_SECONDS
+    while time.monotonic() < time_end:
+        # The server only gets its loop once the port has been bound
+        if updater.httpd is not None and updater.httpd.loop is not None:
+            return True
+        time.sleep(0.1)
+    return False
+
+
 def main():
     """Run the bot."""
+    time_start = time.monotonic()
+    log_listener = logs.start(CONFIG['logging'], FILEPATH_LOG)
+    try:
+        _run(time_start)
+    finally:
+        # Write out the records still waiting in the queue
+        log_listener.stop()
+
+
+def _run(time_start):
     logger.info("Initializing rubus...")
     api_token = _get_api_token()
-    persistence = telegram.ext.PicklePersistence(FILEPATH_DATA)
-    updater = telegram.ext.Updater(api_token, use_context=True, persistence=persistence)
+    bot_persistence = persistence.SQLitePersistence(FILEPATH_DATA)
+    bot_persistence.import_pickle(FILEPATH_DATA_PICKLE)
+    workers = CONFIG['dispatcher']['workers']
+    # Connections are needed for the Dispatcher workers and the comic deliveries
+    # in addition to the few threads of the Updater itself
+    request_kwargs = {'con_pool_size': workers + CONFIG['delivery']['workers'] + 4}
+    updater = telegram.ext.Updater(
+        api_token, workers=workers, request_kwargs=request_kwargs,
+        use_context=True, persistence=bot_persistence)
     dispatcher = updater.dispatcher
     dispatcher.add_error_handler(error)
 
@@ -75,6 +152,7 @@ def main():
             CommandHandler('start', start),
             comics.handler_conversation,
             stickers.handler_conversation,
+            reminders.handler_conversation,
             ],
         states={
             # No higher level states yet implemented
@@ -83,14 +161,21 @@ def main():
             MessageHandler(Filters.all, helper.confused)
         ]
     )
+    for handler in comics.handlers_browse:
+        dispatcher.add_handler(handler)
     dispatcher.add_handler(handler_conversation)
+    dispatcher.add_handler(CommandHandler('stats', metrics.stats))
+    dispatcher.job_queue.run_repeating(metrics.export, metrics.EXPORT_INTERVAL_SECONDS)
 
     logger.debug("Bot ready, initializing submodules")
     comics.init(dispatcher)
+    reminders.init(dispatcher)
 
     logger.info("Init done. Starting...")
-    updater.start_polling(poll_interval=0.1)
-    logger.info("Rubus active!")
+    _start_updates(updater, api_token)
+    startup_seconds = time.monotonic() - time_start
+    metrics.gauge("rubus_startup_seconds", lambda: startup_seconds)
+    logger.info(f"Rubus active in {startup_seconds:.2f} s!")
     updater.idle()
     logger.info("Rubus halted. Exiting...")
 
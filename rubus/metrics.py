@@ -0,0 +1,171 @@
+"""
+Performance metrics of the handlers, jobs, database workers and the crawler.
+
+The metrics are kept in memory and exported in the Prometheus text format
+to a file in the storage as well as summarized through the /stats command for admins.
+"""
+import bisect
+import collections
+import functools
+import logging
+import os
+import threading
+import time
+
+from rubus import helper
+
+
+logger = logging.getLogger(__name__)
+
+CONFIG = helper.config_load()
+FILEPATH_EXPORT = os.path.join(CONFIG['filepaths']['storage'], "metrics.prom")
+EXPORT_INTERVAL_SECONDS = 60
+BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+MESSAGE_LENGTH_MAX = 4096  # Per Telegram message limits
+
+Histogram = collections.namedtuple('Histogram', ['buckets', 'sum', 'count'])
+
+lock = threading.Lock()
+histograms = {}  # (name, labels) -> Histogram
+counters = collections.defaultdict(float)  # (name, labels) -> value
+gauges = {}  # (name, labels) -> callable returning the current value
+
+
+def _key(metric, labels):
+    return metric, tuple(sorted(labels.items()))
+
+
+def observe(metric, value, **labels):
+    """Add an observation to the histogram, e.g. the duration of an operation in seconds"""
+    key = _key(metric, labels)
+    with lock:
+        histogram = histograms.get(key, Histogram((0,) * len(BUCKETS_SECONDS), 0, 0))
+        index = bisect.bisect_left(BUCKETS_SECONDS, value)
+        buckets = histogram.buckets[:index] + (histogram.buckets[index] + 1,) + histogram.buckets[index + 1:]
+        histograms[key] = Histogram(buckets, histogram.sum + value, histogram.count + 1)
+
+
+def increment(metric, amount=1, **labels):
+    """Increase the counter by the amount"""
+    with lock:
+        counters[_key(metric, labels)] += amount
+
+
+def gauge(metric, function, **labels):
+    """Register a function returning the current value of the gauge when exported"""
+    with lock:
+        gauges[_key(metric, labels)] = function
+
+
+def timed(kind):
+    """Decorator observing the duration of each call as rubus_<kind>_duration_seconds"""
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            time_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(f"rubus_{kind}_duration_seconds", time.perf_counter() - time_start, name=func.__name__)
+        return timed_func
+    return decorator
+
+
+def _escape(value):
+    """Escape a label value per the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, **extra):
+    labels = (*labels, *extra.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _snapshot():
+    with lock:
+        return dict(histograms), dict(counters), dict(gauges)
+
+
+def _render_buckets(name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(BUCKETS_SECONDS, histogram.buckets):
+        cumulative += count
+        bound_text = "+Inf" if bound == float('inf') else bound
+        yield f"{name}_bucket{_format_labels(labels, le=bound_text)} {cumulative}"
+
+
+def render():
+    """Render all the metrics in the Prometheus text format"""
+    histograms_copy, counters_copy, gauges_copy = _snapshot()
+
+    families = collections.defaultdict(list)  # name -> lines of the metric family
+    types = {}
+    for (name, labels), histogram in sorted(histograms_copy.items()):
+        types[name] = 'histogram'
+        families[name].extend(_render_buckets(name, labels, histogram))
+        families[name].append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+        families[name].append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    for (name, labels), value in sorted(counters_copy.items()):
+        types[name] = 'counter'
+        families[name].append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), function in sorted(gauges_copy.items()):
+        types[name] = 'gauge'
+        families[name].append(f"{name}{_format_labels(labels)} {function()}")
+
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# TYPE {name} {types[name]}")
+        lines.extend(family)
+    return "\n".join(lines) + "\n"
+
+
+def export(context):  # pylint: disable=unused-argument
+    """Job for writing the metrics atomically to FILEPATH_EXPORT"""
+    filepath_temporary = f"{FILEPATH_EXPORT}.tmp"
+    with open(filepath_temporary, 'w') as outfile:
+        outfile.write(render())
+    os.replace(filepath_temporary, FILEPATH_EXPORT)
+
+
+def _quantile(histogram, quantile):
+    """Upper bound of the bucket containing the quantile"""
+    target = histogram.count * quantile
+    cumulative = 0
+    for bound, count in zip(BUCKETS_SECONDS, histogram.buckets):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float('inf')
+
+
+def summary():
+    """Human readable summary of the metrics fitting into a single message"""
+    histograms_copy, counters_copy, gauges_copy = _snapshot()
+
+    lines = []
+    for (name, labels), histogram in sorted(histograms_copy.items()):
+        mean_ms = histogram.sum / histogram.count * 1000
+        lines.append(
+            f"{name}{_format_labels(labels)}: n={histogram.count} mean={mean_ms:.0f} ms "
+            f"p50<={_quantile(histogram, 0.5)} s p99<={_quantile(histogram, 0.99)} s")
+    for (name, labels), value in sorted(counters_copy.items()):
+        lines.append(f"{name}{_format_labels(labels)}: {value:.0f}")
+    for (name, labels), function in sorted(gauges_copy.items()):
+        lines.append(f"{name}{_format_labels(labels)}: {function()}")
+
+    text = "\n".join(lines) or "No metrics recorded yet"
+    if len(text) > MESSAGE_LENGTH_MAX:
+        text = text[:MESSAGE_LENGTH_MAX - 4] + "\n..."
+    return text
+
+
+def stats(update, context):  # pylint: disable=unused-argument
+    """Handler for /stats, only available for the admins in the configuration"""
+    user = update.effective_user
+    if user is None or user.id not in CONFIG['admins']:
+        logger.info(f"Ignored /stats from non-admin user {user.id if user else None}")
+        return
+
+    update.message.reply_text(summary(), quote=False)
@@ -0,0 +1,73 @@
+"""
+Extract the comic data from the pages at hs.fi.
+
+Each extractor only parses the elements it needs from the page by using a SoupStrainer,
+so building the tree for the rest of the rather heavy document is skipped entirely.
+The extractors take the raw page content and don't do any network access themselves.
+"""
+import datetime
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+PARSER = 'html.parser'
+STRAINER_COMICS_AVAILABLE = SoupStrainer('div', {'class': 'cartoon-content'})
+STRAINER_COMIC_HOMEPAGE = SoupStrainer('figure')
+STRAINER_COMIC_PAGE = SoupStrainer(['span', 'img', 'a'])
+
+
+def comics_available(content):
+    """Extract the name and the homepage URI of each comic listed on the comics frontpage"""
+    soup = BeautifulSoup(content, PARSER, parse_only=STRAINER_COMICS_AVAILABLE)
+
+    comic_data = []
+    for comic_content in soup.find_all('div', {'class': 'cartoon-content'}):
+        name = comic_content.find('span', {'class': 'title'}).get_text()
+        uri = comic_content.find('meta', {'itemprop': 'contentUrl'})['content']
+        comic_data.append({'name': name, 'uri': uri})
+    return comic_data
+
+
+def comic_uri_latest(content):
+    """Extract the URI of the individual page of the latest comic from its homepage"""
+    soup = BeautifulSoup(content, PARSER, parse_only=STRAINER_COMIC_HOMEPAGE)
+    latest_comic = soup.find('figure')
+    return latest_comic.find('meta', {'itemprop': 'contentUrl'})['content']
+
+
+def comic_page(content, today=None):
+    """Extract the date, the image URL and the URI of the previous comic from a comic page
+
+    The URI of the previous comic is None for the very first comic.
+    """
+    soup = BeautifulSoup(content, PARSER, parse_only=STRAINER_COMIC_PAGE)
+
+    date_text_with_day_of_week = soup.find('span', {'class': 'date'}).text
+    date = _parse_date(date_text_with_day_of_week.split(' ')[-1], today)
+
+    image_element = soup.find('img', {'data-srcset': True})
+    # The element includes a low-res and high-res partial URI but we want only the high-res one,
+    # which is in the attribute 'data-srcset' in the format "<link> 1920w"
+    image_uri = image_element['data-srcset'].split(' ')[0]
+    # image_uri is of format '//hs.mediadelivery.fi/...'
+    image_url = f"https:{image_uri}"
+
+    # Crawl backwards using the "Previous" button on the page
+    previous_element = soup.find('a', {'class': 'article-navlink prev'})
+    uri_previous = None if previous_element is None else previous_element['href']
+
+    return {
+        'date': date,
+        'image_url': image_url,
+        'uri_previous': uri_previous,
+    }
+
+
+def _parse_date(date_text, today=None):
+    try:
+        return datetime.datetime.strptime(date_text, r"%d.%m.%Y").date()
+    except ValueError:
+        # Comics released in the current year don't include the year by default in the text
+        if today is None:
+            today = datetime.datetime.now().date()
+        return datetime.datetime.strptime(f"{date_text}{today.year}", r"%d.%m.%Y").date()
@@ -0,0 +1,154 @@
+"""
+Persistence of the bot data in SQLite.
+
+Each user_data, chat_data and conversation state is stored as its own row,
+which is only written when that entry has changed. Thus, the cost of persisting
+stays proportional to the changes instead of the total amount of stored data.
+"""
+import collections
+import functools
+import json
+import logging
+import os
+import pickle
+import queue
+import threading
+
+from telegram.ext import BasePersistence
+
+from rubus import helper
+from rubus import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Append only, see helper.database_migrate
+MIGRATIONS = [
+    [
+        "CREATE TABLE entries (kind TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (kind, key))",
+    ],
+]
+
+KIND_USER_DATA = "user_data"
+KIND_CHAT_DATA = "chat_data"
+KIND_BOT_DATA = "bot_data"
+KIND_CONVERSATION_PREFIX = "conversation:"
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence storing the data in SQLite with dirty tracking per entry
+
+    An entry is considered dirty if its pickled form differs from the one last written.
+    Changes are written immediately, so there is nothing left to do on flush.
+    """
+    def __init__(self, filepath):
+        super().__init__(store_user_data=True, store_chat_data=True)
+        self.queries = queue.Queue()
+        self.database_query = functools.partial(helper.database_query, self.queries)
+        worker = threading.Thread(
+            target=helper.database_worker,
+            args=(filepath, self.queries, functools.partial(
+                metrics.observe, "rubus_database_query_duration_seconds", database="persistence")),
+            daemon=True)
+        worker.start()
+        metrics.gauge("rubus_database_queue_depth", self.queries.qsize, database="persistence")
+        helper.database_migrate(self.queries, MIGRATIONS)
+
+        # Last written pickle of each entry by (kind, key)
+        self.written = {}
+        self.written_lock = threading.Lock()
+
+    def _load(self, kind):
+        entries = {}
+        for key, data in self.database_query("SELECT key, data FROM entries WHERE kind = ?", kind):
+            with self.written_lock:
+                self.written[(kind, key)] = data
+            entries[key] = pickle.loads(data)
+        return entries
+
+    def _update(self, kind, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.written_lock:
+            if self.written.get((kind, key)) == data:
+                return
+            self.written[(kind, key)] = data
+
+        self.database_query(
+            "INSERT OR REPLACE INTO entries (kind, key, data) VALUES (?, ?, ?)", kind, key, data)
+
+    def _delete(self, kind, key):
+        with self.written_lock:
+            if self.written.pop((kind, key), None) is None:
+                return
+
+        self.database_query("DELETE FROM entries WHERE kind = ? AND key = ?", kind, key)
+
+    def get_user_data(self):
+        """Returns the user_data of all users as a defaultdict"""
+        entries = self._load(KIND_USER_DATA)
+        return collections.defaultdict(dict, {int(key): value for key, value in entries.items()})
+
+    def get_chat_data(self):
+        """Returns the chat_data of all chats as a defaultdict"""
+        entries = self._load(KIND_CHAT_DATA)
+        return collections.defaultdict(dict, {int(key): value for key, value in entries.items()})
+
+    def get_bot_data(self):
+        """Returns the bot_data, only used by python-telegram-bot >= 12.4"""
+        return self._load(KIND_BOT_DATA).get("", {})
+
+    def get_conversations(self, name):
+        """Returns the states of the conversations of the named ConversationHandler"""
+        entries = self._load(f"{KIND_CONVERSATION_PREFIX}{name}")
+        return {tuple(json.loads(key)): state for key, state in entries.items()}
+
+    def update_user_data(self, user_id, data):
+        """Write the user_data of the user if it has changed"""
+        self._update(KIND_USER_DATA, str(user_id), data)
+
+    def update_chat_data(self, chat_id, data):
+        """Write the chat_data of the chat if it has changed"""
+        self._update(KIND_CHAT_DATA, str(chat_id), data)
+
+    def update_bot_data(self, data):
+        """Write the bot_data if it has changed, only used by python-telegram-bot >= 12.4"""
+        self._update(KIND_BOT_DATA, "", data)
+
+    def update_conversation(self, name, key, new_state):
+        """Write the state of the conversation if it has changed"""
+        kind = f"{KIND_CONVERSATION_PREFIX}{name}"
+        key = json.dumps(key)
+        if new_state is None:
+            self._delete(kind, key)
+        else:
+            self._update(kind, key, new_state)
+
+    def flush(self):
+        """Nothing to do as all the changes have been written already"""
+
+    def import_pickle(self, filepath):
+        """Import the data stored earlier by a PicklePersistence in a single file
+
+        The pickle file is renamed afterwards, so the import is only done once.
+        """
+        if not os.path.exists(filepath):
+            return
+
+        logger.info(f"Importing persistence data from {filepath}")
+        with open(filepath, 'rb') as infile:
+            data = pickle.load(infile)
+
+        entries = []
+        for kind in (KIND_USER_DATA, KIND_CHAT_DATA):
+            entries.extend((kind, str(key), value) for key, value in data.get(kind, {}).items())
+        if data.get(KIND_BOT_DATA):
+            entries.append((KIND_BOT_DATA, "", data[KIND_BOT_DATA]))
+        for name, conversations in data.get('conversations', {}).items():
+            entries.extend((f"{KIND_CONVERSATION_PREFIX}{name}", json.dumps(key), state)
+                           for key, state in conversations.items() if state is not None)
+        rows = [(kind, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for kind, key, value in entries]
+
+        helper.database_query_many(
+            self.queries, "INSERT OR REPLACE INTO entries (kind, key, data) VALUES (?, ?, ?)", rows)
+        os.replace(filepath, f"{filepath}.imported")
+        logger.info(f"Imported {len(rows)} persistence entries")
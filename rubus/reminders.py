@@ -1,19 +1,76 @@
 """
 Reminders of upcoming events requested by users.
+
+The reminders are stored in SQLite indexed by the time they are due next. A single timer
+thread sleeps until the earliest one is due, so the amount of reminders doesn't add any
+jobs to the JobQueue nor anything to the persisted bot data. Only pending reminders
+remain in the database, one-shot ones are deleted once they have been sent.
 """
+import datetime
 import enum
+import functools
 import logging
+import os
+import queue
+import re
+import threading
+import time
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler
+from telegram.error import BadRequest, Unauthorized
 from telegram.ext import Filters
 
+from rubus import delivery
 from rubus import helper
+from rubus import metrics
 
 
-logger = logging.getLogger('rubus')
+logger = logging.getLogger(__name__)
 
 CONFIG = helper.config_load()
+REMINDERS_PER_CHAT_MAX = 50
+REMINDER_LIST_TEXT_LENGTH = 32
+TIMER_RETRY_SECONDS = 60
+# A failed reminder is retried after 1, 2, 4 and 8 minutes before giving up on it
+DELIVERY_RETRY_SECONDS = 60
+DELIVERY_ATTEMPTS_MAX = 5
+# Keeps the ids of the reminders apart from the values of Command in the callback data
+CALLBACK_PREFIX_REMINDER = "reminder:"
+REPEAT_INTERVAL_DAYS = {'daily': 1, 'weekly': 7}
+# E.g. "weekly 2020-03-10 18:00 Sauna", where only the time and the text are required
+PATTERN_REMINDER = re.compile(
+    r"^(?:(?P<repeat>daily|weekly)\s+)?(?:(?P<date>\d{4}-\d{2}-\d{2})\s+)?(?P<time>\d{1,2}:\d{2})\s+(?P<text>.+)$",
+    re.IGNORECASE | re.DOTALL)
+
+DATABASE_FILEPATH = os.path.join(CONFIG['filepaths']['storage'], "reminders.db")
+queries = queue.Queue()
+database_query = functools.partial(helper.database_query, queries)
+database_query_single = functools.partial(helper.database_query_single, queries)
+database_transaction = functools.partial(helper.database_transaction, queries)
+database_observe = functools.partial(metrics.observe, "rubus_database_query_duration_seconds", database="reminders")
+
+# Append only, see helper.database_migrate
+MIGRATIONS = [
+    [
+        # next_fire is a UNIX timestamp and interval_days is NULL for one-shot reminders
+        "CREATE TABLE reminders (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, text TEXT NOT NULL, "
+        "next_fire REAL NOT NULL, interval_days INTEGER)",
+        "CREATE INDEX reminders_next_fire ON reminders (next_fire)",
+        "CREATE INDEX reminders_chat_id ON reminders (chat_id)",
+    ],
+    [
+        # While a reminder is being retried, next_fire is the time of the next attempt
+        # and fire_scheduled keeps the time the recurring ones are scheduled from
+        "ALTER TABLE reminders ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE reminders ADD COLUMN fire_scheduled REAL",
+    ],
+]
+
+# Interrupts the sleep of the timer whenever the reminders have changed
+wakeup = threading.Event()
+# Result of a reminder which can never be delivered, e.g. to a chat the bot has been removed from
+UNDELIVERABLE = object()
 
 
 class State(enum.IntEnum):
@@ -23,6 +80,8 @@ class State(enum.IntEnum):
     The performed actions may depend on the message content.
     """
     MENU = enum.auto()
+    ADD = enum.auto()
+    REMOVE = enum.auto()
 
 
 class Command(enum.IntEnum):
@@ -30,12 +89,146 @@ class Command(enum.IntEnum):
 
     Can be directly used as a value for the CallbackQueryHandler from the InlineKeyboard.
     """
+    ADD_MENU = enum.auto()
+    REMOVE_MENU = enum.auto()
     CANCEL = enum.auto()
 
 
-def start(update, context):
+def init(dispatcher):
+    """At bot startup this function should be executed to start sending the reminders"""
+    logger.info("Setting up database worker for reminders")
+    worker = threading.Thread(
+        target=helper.database_worker,
+        args=(DATABASE_FILEPATH, queries, database_observe),
+        daemon=True)
+    worker.start()
+    metrics.gauge("rubus_database_queue_depth", queries.qsize, database="reminders")
+    helper.database_migrate(queries, MIGRATIONS)
+
+    pending = database_query_single("SELECT COUNT(*) FROM reminders")
+    logger.info(f"Starting timer for {pending} pending reminders")
+    timer = threading.Thread(target=_timer, args=(dispatcher.bot,), name="reminders-timer", daemon=True)
+    timer.start()
+
+
+def _timer(bot):
+    """Sleep until the earliest reminder is due, send all the due reminders and repeat"""
+    while True:
+        try:
+            next_fire = database_query_single("SELECT MIN(next_fire) FROM reminders")
+            timeout = None if next_fire is None else max(0, next_fire - time.time())
+            if wakeup.wait(timeout):
+                # Something was added or removed, which may change the earliest reminder
+                wakeup.clear()
+                continue
+            _send_due(bot)
+        except Exception:  # pylint: disable=broad-except
+            # The timer must keep running for the rest of the reminders
+            logger.exception("Failed to send reminders")
+            time.sleep(TIMER_RETRY_SECONDS)
+
+
+def _send_due(bot):
+    """Send every reminder which is due and schedule the recurring ones again
+
+    A reminder which failed to be delivered is retried later with a backoff, while those
+    which never can be, or have run out of attempts, are handled as if they had been sent.
+    """
+    time_now = time.time()
+    due = database_query(
+        "SELECT id, chat_id, text, COALESCE(fire_scheduled, next_fire), interval_days, attempts FROM reminders "
+        "WHERE next_fire <= ? ORDER BY next_fire",
+        time_now)
+
+    deliveries = [
+        delivery.Delivery(chat_id, functools.partial(_send, bot, chat_id, text))
+        for _, chat_id, text, _, _, _ in due
+    ]
+    results = delivery.deliver(deliveries)
+    sent = sum(result is not None and result is not UNDELIVERABLE for result in results)
+    logger.info(f"Sent {sent}/{len(due)} reminders")
+
+    with database_transaction() as transaction:
+        for (reminder_id, chat_id, _, fire, interval_days, attempts), result in zip(due, results):
+            if result is None and attempts + 1 < DELIVERY_ATTEMPTS_MAX:
+                # Only this reminder waits for the retry, the timer keeps going for the rest
+                transaction.execute(
+                    "UPDATE reminders SET next_fire = ?, fire_scheduled = ?, attempts = ? WHERE id = ?",
+                    time_now + DELIVERY_RETRY_SECONDS * 2 ** attempts, fire, attempts + 1, reminder_id)
+                continue
+
+            if result is None:
+                logger.warning(f"Giving up on reminder {reminder_id} to {chat_id} after {attempts + 1} attempts")
+            if interval_days is None:
+                transaction.execute("DELETE FROM reminders WHERE id = ?", reminder_id)
+            else:
+                transaction.execute(
+                    "UPDATE reminders SET next_fire = ?, fire_scheduled = NULL, attempts = 0 WHERE id = ?",
+                    _next_fire(fire, interval_days, time_now), reminder_id)
+
+
+def _send(bot, chat_id, text):
+    """Send the reminder, returns UNDELIVERABLE instead of raising if the chat can't ever receive it"""
+    try:
+        return bot.send_message(chat_id, f"Reminder: {text}")
+    except (Unauthorized, BadRequest) as exception:
+        logger.warning(f"Reminder can't be delivered to {chat_id}: {exception.message}")
+        return UNDELIVERABLE
+
+
+def _next_fire(fire, interval_days, time_now):
+    """Next time of a recurring reminder after time_now
+
+    The arithmetic is done in local time, so the reminder stays at the same time of day
+    over daylight saving time changes. Occurrences missed while the bot was down are skipped.
+    """
+    fire_local = datetime.datetime.fromtimestamp(fire)
+    intervals_missed = max(0, int((time_now - fire) // datetime.timedelta(days=interval_days).total_seconds()))
+    fire_local += datetime.timedelta(days=interval_days * intervals_missed)
+    while fire_local.timestamp() <= time_now:
+        fire_local += datetime.timedelta(days=interval_days)
+    return fire_local.timestamp()
+
+
+def _parse(text, time_now):
+    """Parse a reminder of the format "[daily|weekly] [YYYY-MM-DD] HH:MM <text>"
+
+    Without a date the reminder is due at the next such time of day.
+    Returns a tuple (next_fire, interval_days, text) or None if the text isn't a valid future reminder.
+    """
+    match = PATTERN_REMINDER.match(text.strip())
+    if match is None:
+        return None
+
+    date_now = datetime.datetime.fromtimestamp(time_now).date()
+    try:
+        date = date_now if match['date'] is None else datetime.date.fromisoformat(match['date'])
+        time_of_day = datetime.datetime.strptime(match['time'], r"%H:%M").time()
+    except ValueError:
+        return None
+
+    fire = datetime.datetime.combine(date, time_of_day).timestamp()
+    interval_days = None if match['repeat'] is None else REPEAT_INTERVAL_DAYS[match['repeat'].lower()]
+    if fire <= time_now:
+        if match['date'] is None:
+            fire = _next_fire(fire, 1, time_now)
+        elif interval_days is not None:
+            fire = _next_fire(fire, interval_days, time_now)
+        else:
+            return None
+
+    return fire, interval_days, match['text'].strip()
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime(r"%Y-%m-%d %H:%M")
+
+
+def start(update, context):  # pylint: disable=unused-argument
     """Present the user all available reminder configuration options"""
     keyboard = [
+        [InlineKeyboardButton("Add a reminder", callback_data=Command.ADD_MENU)],
+        [InlineKeyboardButton("Remove a reminder", callback_data=Command.REMOVE_MENU)],
         [InlineKeyboardButton("Cancel", callback_data=Command.CANCEL)],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -43,11 +236,100 @@ def start(update, context):
     return State.MENU
 
 
+def _add_menu(update, context):  # pylint: disable=unused-argument
+    """Instruct the user how to write the reminder"""
+    keyboard = [
+        [InlineKeyboardButton("Cancel", callback_data=Command.CANCEL)],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    query = update.callback_query
+    query.message.edit_text(
+        "Send me the reminder as [daily|weekly] [YYYY-MM-DD] HH:MM <text>, "
+        "e.g. \"18:00 Sauna\" or \"weekly 2020-03-10 18:00 Sauna\"",
+        reply_markup=reply_markup)
+    return State.ADD
+
+
+@helper.run_async
+@metrics.timed('handler')
+def _add(update, context):  # pylint: disable=unused-argument
+    """Store the reminder sent by the user"""
+    message = update.message
+    chat_id = message.chat_id
+
+    reminder = _parse(message.text, time.time())
+    if reminder is None:
+        message.reply_text("That is not a reminder in the future, please try again")
+        return State.ADD
+
+    if database_query_single("SELECT COUNT(*) FROM reminders WHERE chat_id = ?", chat_id) >= REMINDERS_PER_CHAT_MAX:
+        message.reply_text(f"There can be at most {REMINDERS_PER_CHAT_MAX} reminders per chat")
+        return ConversationHandler.END
+
+    next_fire, interval_days, text = reminder
+    database_query(
+        "INSERT INTO reminders (chat_id, text, next_fire, interval_days) VALUES (?, ?, ?, ?)",
+        chat_id, text, next_fire, interval_days)
+    wakeup.set()
+
+    repeat = "" if interval_days is None else f", repeating every {interval_days} days"
+    message.reply_text(f"Reminder set for {_format_time(next_fire)}{repeat}")
+    return ConversationHandler.END
+
+
+@helper.run_async
+@metrics.timed('handler')
+def _remove_menu(update, context):  # pylint: disable=unused-argument
+    """Present the user the reminders of the chat"""
+    query = update.callback_query
+    reminders = database_query(
+        "SELECT id, text, next_fire FROM reminders WHERE chat_id = ? ORDER BY next_fire", query.message.chat_id)
+
+    buttons = [
+        [InlineKeyboardButton(
+            f"{_format_time(next_fire)} {text[:REMINDER_LIST_TEXT_LENGTH]}",
+            callback_data=f"{CALLBACK_PREFIX_REMINDER}{reminder_id}")]
+        for reminder_id, text, next_fire in reminders
+    ]
+    keyboard = [
+        *buttons,
+        [InlineKeyboardButton("Cancel", callback_data=Command.CANCEL)],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    text = "Select the reminder to remove:" if reminders else "No reminders set"
+    query.message.edit_text(text, reply_markup=reply_markup)
+    return State.REMOVE
+
+
+@helper.run_async
+@metrics.timed('handler')
+def _remove(update, context):  # pylint: disable=unused-argument
+    """Remove the selected reminder"""
+    query = update.callback_query
+    # The chat must match as well so that only reminders of the chat itself can be removed
+    reminder_id = int(query.data[len(CALLBACK_PREFIX_REMINDER):])
+    database_query("DELETE FROM reminders WHERE id = ? AND chat_id = ?", reminder_id, query.message.chat_id)
+    wakeup.set()
+
+    query.message.edit_text("Reminder removed")
+    return ConversationHandler.END
+
+
 handler_conversation = ConversationHandler(
     entry_points=[CommandHandler('reminders', start)],
     states={
         State.MENU: [
+            CallbackQueryHandler(_add_menu, pattern=f"^{Command.ADD_MENU}$"),
+            CallbackQueryHandler(_remove_menu, pattern=f"^{Command.REMOVE_MENU}$"),
+            CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
+            ],
+        State.ADD: [
+            CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
+            MessageHandler(Filters.text, _add),
+            ],
+        State.REMOVE: [
             CallbackQueryHandler(helper.cancel, pattern=f"^{Command.CANCEL}$"),
+            CallbackQueryHandler(_remove, pattern=f"^{CALLBACK_PREFIX_REMINDER}[0-9]+$"),
             ],
     },
     fallbacks=[MessageHandler(Filters.all, helper.confused)]
@@ -3,9 +3,8 @@ Managing Telegram sticker sets and stickers using the bot interface.
 """
 import enum
 import hashlib
+import io
 import logging
-import os
-import tempfile
 
 from PIL import Image
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,11 +13,19 @@ from telegram.ext import Filters
 from telegram.error import BadRequest
 
 from rubus import helper
+from rubus import metrics
 
 
-logger = logging.getLogger('rubus')
+logger = logging.getLogger(__name__)
 
 STICKER_DIMENSION_SIZE_PIXELS = 512  # Per Telegram sticker requirements
+STICKER_FILE_SIZE_LIMIT_BYTES = 512 * 1024  # Per Telegram sticker requirements
+CONVERSION_WORKERS = 2
+
+conversion_pool = helper.ProcessPool(CONVERSION_WORKERS)
+
+# Sticker sets are only modified through the bot, so they can be cached for quite long
+sticker_sets = helper.TTLCache(maxsize=128, ttl_seconds=60 * 60)
 
 
 class State(enum.IntEnum):
@@ -63,10 +70,9 @@ def _sticker_set_name(update, context):
     hash_object = hashlib.md5(f"{chat.id}{user.id}".encode('utf-8'))
     prefix = hash_object.hexdigest()
 
-    # The name must end in _by_<bot_username> per Telegram rules
-    bot = context.bot
-    bot_user_account = bot.get_me()
-    sticker_set_name = f"Set_{prefix}_by_{bot_user_account['username']}"
+    # The name must end in _by_<bot_username> per Telegram rules.
+    # The Bot caches its own user on the first access so this is not an API call every time.
+    sticker_set_name = f"Set_{prefix}_by_{context.bot.username}"
     logger.debug(f"Formed sticker set name '{sticker_set_name}'")
     return sticker_set_name
 
@@ -76,14 +82,31 @@ def _sticker_set_exists(update, context, sticker_set_name=None):
         sticker_set_name = _sticker_set_name(update, context)
 
     try:
-        context.bot.get_sticker_set(sticker_set_name)
+        return _sticker_set(context.bot, sticker_set_name) is not None
+    except BadRequest:
+        return True
+
+
+def _sticker_set(bot, sticker_set_name):
+    """Get the sticker set from the cache or from Telegram, None if it doesn't exist"""
+    sticker_set = sticker_sets.get(sticker_set_name)
+    if sticker_set is not None:
+        return sticker_set
+
+    logger.debug(f"Sticker set cache hits {sticker_sets.hits}, misses {sticker_sets.misses}")
+    try:
+        sticker_set = bot.get_sticker_set(sticker_set_name)
     except BadRequest as exception:
         if exception.message == "Stickerset_invalid":
-            return False
+            return None
+        raise
 
-    return True
+    sticker_sets.set(sticker_set_name, sticker_set)
+    return sticker_set
 
 
+@helper.run_async
+@metrics.timed('handler')
 def add_sticker_start(update, context):  # pylint: disable=unused-argument
     """Start routine of adding a sticker to an existing set
 
@@ -112,7 +135,33 @@ def add_sticker_set_title(update, context):
     return State.ADD_STICKER_PHOTO
 
 
-def _resize_and_convert_to_png(update, context, temporary_directory):
+def _convert_to_png(image_data):
+    """Resize and convert the image to a PNG fulfilling the sticker requirements
+
+    Runs in the conversion pool, so only bytes are passed in and out.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    # Let the JPEG decoder already scale the image down by a power of two while decoding.
+    # The result is still at least the requested size, so this saves memory at no cost.
+    image.draft('RGB', (STICKER_DIMENSION_SIZE_PIXELS, STICKER_DIMENSION_SIZE_PIXELS))
+    # At least one dimension must be STICKER_DIMENSION_SIZE_PIXELS
+    # and neither dimension can exceed this value
+    longest_dimension = max(image.size)
+    ratio = STICKER_DIMENSION_SIZE_PIXELS / longest_dimension
+    width_new = int(image.size[0] * ratio)
+    height_new = int(image.size[1] * ratio)
+    image_resized = image.resize((width_new, height_new), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image_resized.save(buffer, 'PNG', optimize=True)
+    if buffer.tell() > STICKER_FILE_SIZE_LIMIT_BYTES:
+        # Photos don't compress that well as PNG, so fall back to a palette of 256 colors
+        buffer = io.BytesIO()
+        image_resized.quantize(256).save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _resize_and_convert_to_png(update, context):
     # A photo can have multiple PhotoSize elements tied together
     # but we want to use the largest one for possible resize operations
     photos = update.message.photo
@@ -120,34 +169,33 @@ def _resize_and_convert_to_png(update, context, temporary_directory):
     file = context.bot.get_file(photo.file_id)
     # The file is stored as .jpg on Telegram servers
     # so we need to resize and convert it manually to .png
-    filepath_jpg = os.path.join(temporary_directory, "photo.jpg")
-    file.download(custom_path=filepath_jpg)
-    image_jpg = Image.open(filepath_jpg)
-    # At least one dimension must be STICKER_DIMENSION_SIZE_PIXELS
-    # and neither dimension can exceed this value
-    longest_dimension = max(image_jpg.size)
-    ratio = STICKER_DIMENSION_SIZE_PIXELS / longest_dimension
-    width_new = int(image_jpg.size[0] * ratio)
-    height_new = int(image_jpg.size[1] * ratio)
-    image_resized = image_jpg.resize((width_new, height_new))
-
-    filepath_png = os.path.join(temporary_directory, "photo.png")
-    image_resized.save(filepath_png)
-    return filepath_png
+    image_data = bytes(file.download_as_bytearray())
+    png_data = conversion_pool.submit(_convert_to_png, image_data).result()
+    logger.debug(f"Converted a {len(image_data)} byte photo to a {len(png_data)} byte sticker")
+    return io.BytesIO(png_data)
 
 
+@helper.run_async
+@metrics.timed('handler')
 def add_sticker_photo(update, context):
     """Get a photo from the user and convert it to the required format"""
-    with tempfile.TemporaryDirectory() as temporary_directory:
-        filepath_png = _resize_and_convert_to_png(update, context, temporary_directory)
-        with open(filepath_png, 'rb') as png_sticker:
-            file = context.bot.upload_sticker_file(update.effective_user['id'], png_sticker)
+    try:
+        png_sticker = _resize_and_convert_to_png(update, context)
+    except Exception:  # pylint: disable=broad-except
+        # E.g. a conversion process killed for running out of memory or an image PIL can't read
+        logger.exception("Failed to convert the photo to a sticker")
+        update.message.reply_text("Sorry, I couldn't convert that photo. Send me another one.")
+        return State.ADD_STICKER_PHOTO
+
+    file = context.bot.upload_sticker_file(update.effective_user['id'], png_sticker)
 
     context.user_data['sticker_file_id'] = file.file_id
     update.message.reply_text("Send me the emojis (1 to 3) matching the photo")
     return State.ADD_STICKER_EMOJI
 
 
+@helper.run_async
+@metrics.timed('handler')
 def add_sticker_emoji(update, context):
     """Get 1 to 3 emoji(s) from the user and add a new sticker to the current set"""
     user = update.effective_user
@@ -182,7 +230,10 @@ def add_sticker_emoji(update, context):
         success = False
 
     if success:
+        # The API only tells whether the sticker was added, so the set has to be fetched anyway
+        # to know the new sticker. It is also the latest state of the set for the cache.
         sticker_set = bot.get_sticker_set(sticker_set_name)
+        sticker_sets.set(sticker_set_name, sticker_set)
         sticker = sticker_set.stickers[-1]  # Latest sticker will be last in the list
         # Note that sticker.file_id is different from sticker_file_id
         # Telegram uses a different id for a sticker included in a set for some reason
@@ -0,0 +1,73 @@
+"""
+Content-addressed storage for downloaded files.
+
+Files are named by the SHA-256 hash of their content and spread over two levels of
+subdirectories, so identical files are stored only once and no single directory
+grows too large to list quickly.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE_BYTES = 64 * 1024
+DIRECTORY_TEMPORARY = "tmp"
+
+
+def content_filepath(directory, digest, extension=""):
+    """Filepath of the content with the given hex digest, e.g. <directory>/ab/cd/abcd...<extension>"""
+    return os.path.join(directory, digest[:2], digest[2:4], f"{digest}{extension}")
+
+
+def store_stream(directory, chunks, extension=""):
+    """Store content given as an iterable of bytes chunks
+
+    The content is written to a temporary file while being hashed, which is then
+    atomically renamed to its final place. Thus, a crash may never leave a truncated
+    file behind and only a single chunk is kept in memory at a time.
+
+    Returns the filepath of the stored content.
+    """
+    # The temporary file must be on the same filesystem for the rename to be atomic
+    directory_temporary = os.path.join(directory, DIRECTORY_TEMPORARY)
+    os.makedirs(directory_temporary, exist_ok=True)
+
+    hash_object = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=directory_temporary, delete=False) as outfile:
+        try:
+            for chunk in chunks:
+                hash_object.update(chunk)
+                outfile.write(chunk)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        except BaseException:
+            os.unlink(outfile.name)
+            raise
+
+    filepath = content_filepath(directory, hash_object.hexdigest(), extension)
+    if os.path.exists(filepath):
+        logger.debug(f"{filepath} already stored")
+        os.unlink(outfile.name)
+    else:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        os.replace(outfile.name, filepath)
+    return filepath
+
+
+def store_bytes(directory, data, extension=""):
+    """Store content which is already fully in memory"""
+    return store_stream(directory, [data], extension)
+
+
+def cleanup(directory):
+    """Remove temporary files left behind by an interrupted process"""
+    directory_temporary = os.path.join(directory, DIRECTORY_TEMPORARY)
+    if not os.path.isdir(directory_temporary):
+        return
+
+    for filename in os.listdir(directory_temporary):
+        logger.info(f"Removing leftover temporary file {filename}")
+        os.unlink(os.path.join(directory_temporary, filename))